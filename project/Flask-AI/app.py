@@ -1,12 +1,55 @@
-from flask import Flask, request, jsonify
+import json
+import time
+from flask import Flask, Response, request, jsonify, stream_with_context
 from llm import *
+from columnar import format_error, result_format, to_columnar_json, to_arrow_ipc
+from db import pool_stats, guard_stats, statement_timeout_ms
+from metrics import TRACE_HEADER, stage_latency, start_trace, current_trace, server_timing, render_histograms, render_gauges
+from ollama_client import latency, latency_stats
+from router import router
 
 app = Flask(__name__)
 
+@app.before_request
+def begin_trace():
+    start_trace()
+
+@app.after_request
+def add_trace_header(response):
+    trace = current_trace()
+    wanted = TRACE_HEADER or request.args.get("trace", "false").lower() in ("1", "true", "yes")
+    if trace and wanted:
+        response.headers["Server-Timing"] = server_timing(trace)
+    return response
+
+def flag(data, name, default=True):
+    return str(data.get(name, default)).lower() not in ("0", "false", "no")
+
+def wants_stream(data):
+    stream = request.args.get("stream", data.get("stream", False))
+    return str(stream).lower() in ("1", "true", "yes")
+
+def ndjson_stream(events):
+    # Newline-delimited JSON, the same framing Ollama uses for its own stream
+    def generate():
+        for event in events:
+            yield json.dumps(event) + "\n"
+        yield json.dumps({"done": True}) + "\n"
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/generate")
 def generate():
     data = request.json
     prompt = data.get("prompt", "")
+    
+    if wants_stream(data):
+        return ndjson_stream({"response": token} for token in stream_prompt(prompt))
+    
     response = generate_prompt(prompt)
     
     return jsonify({"response": response})
@@ -17,8 +60,17 @@ def schemas():
     user = request.args.get("user", "admin")
     password = request.args.get("password", "secret")
     
-    schemas_md = get_db_schema(dbname, user, password)
+    refresh = request.args.get("refresh", "false").lower() in ("1", "true", "yes")
+    
+    schemas_md = get_db_schema(dbname, user, password, refresh=refresh)
     return jsonify({"schema": schemas_md})
+
+@app.post("/schemas/invalidate")
+def invalidate_schemas():
+    dbname = request.args.get("dbname")
+    
+    invalidated = invalidate_schema_cache(dbname)
+    return jsonify({"invalidated": invalidated, "cache": schema_cache_stats()})
     
 @app.post("/analyze")
 def analyze():
@@ -27,10 +79,129 @@ def analyze():
     dbname = request.args.get("dbname", "flask_db")
     user = request.args.get("user", "admin")
     password = request.args.get("password", "secret")
+    use_cache = flag(data, "cache")
+    use_result_cache = flag(data, "result_cache", use_cache)
+    statement_timeout = statement_timeout_ms(data.get("statement_timeout"))
+    candidates = candidate_count(data.get("candidates"))
+    
+    if wants_stream(data):
+        def events():
+            result = analyze_query(question, dbname, user, password, use_cache=use_cache,
+                                   statement_timeout=statement_timeout, use_result_cache=use_result_cache,
+                                   candidates=candidates)
+            yield {"data": result["data"], "row_count": result["row_count"], "truncated": result["truncated"],
+                   "cached": result["cached"], "candidates": result.get("candidates")}
+            for token in stream_analysis(question, result["context"]):
+                yield {"response": token}
+        
+        return ndjson_stream(events())
+    
+    # Checked up front so a bad format doesn't cost a query and an LLM call first
+    output = result_format(request.args.get("format", data.get("format")))
+    error = format_error(output)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+    
+    result = analyze_query(question, dbname, user, password, use_cache=use_cache,
+                           statement_timeout=statement_timeout, use_result_cache=use_result_cache,
+                           candidates=candidates)
+    analysis = response_analysis(question, result["context"]) if flag(data, "analysis") else None
+    headers = {
+        "X-Result-Rows": str(result["row_count"]),
+        "X-Result-Truncated": str(result["truncated"]).lower(),
+        "X-Result-Cached": str(result["cached"]).lower(),
+        "X-SQL-Candidates": str(len(result.get("candidates") or [result["sql"]])),
+    }
+    
+    # A failed query has no result set, only the error text in "data"
+    rows = result.get("result", {"columns": [], "types": [], "rows": []})
+    error = None if "result" in result else result["data"]
+    if output == "columnar":
+        return jsonify({
+            "analysis": analysis,
+            "sql": result["sql"],
+            "row_count": result["row_count"],
+            "truncated": result["truncated"],
+            "cached": result["cached"],
+            "error": error,
+            "candidates": result.get("candidates"),
+            "result": to_columnar_json(rows["columns"], rows["types"], rows["rows"]),
+        }), 200, headers
+    if output == "arrow":
+        body = to_arrow_ipc(rows["columns"], rows["types"], rows["rows"],
+                            metadata={"sql": result["sql"], "analysis": analysis or ""})
+        return Response(body, mimetype="application/vnd.apache.arrow.stream", headers=headers)
     
-    response = analyze_response(question, dbname, user, password)
-    analysis = response_analysis(question, response)
-    return analysis
+    return analysis or "", 200, headers
+
+@app.post("/analyze/batch")
+def analyze_batch_endpoint():
+    data = request.json
+    questions = data.get("questions", [])
+    error = batch_error(questions)
+    if error:
+        return jsonify({"error": error}), 400
+    dbname = request.args.get("dbname", "flask_db")
+    user = request.args.get("user", "admin")
+    password = request.args.get("password", "secret")
+    use_cache = flag(data, "cache")
+    with_analysis = flag(data, "analysis")
+    statement_timeout = statement_timeout_ms(data.get("statement_timeout"))
+    
+    start = time.perf_counter()
+    results = analyze_batch(questions, dbname, user, password, use_cache=use_cache,
+                            statement_timeout=statement_timeout, with_analysis=with_analysis,
+                            candidates=candidate_count(data.get("candidates")))
+    return jsonify({"results": results, "elapsed": time.perf_counter() - start})
+
+@app.post("/results/invalidate")
+def invalidate_results():
+    table = request.args.get("table")
+    dbname = request.args.get("dbname")
+    
+    invalidated = invalidate_result_cache(table, dbname)
+    return jsonify({"invalidated": invalidated, "cache": result_cache_stats()})
+
+@app.get("/sql-cache")
+def sql_cache():
+    return jsonify(sql_cache_stats())
+
+@app.get("/metrics")
+def metrics():
+    pools = pool_stats()
+    caches = {"schema": schema_cache_stats(), "sql": sql_cache_stats(), "result": result_cache_stats()}
+    
+    text = render_histograms("flask_ai_stage_duration_seconds", "Pipeline stage latency in seconds", stage_latency, "stage")
+    text += render_histograms("flask_ai_ollama_duration_seconds", "Ollama call latency in seconds", latency, "call")
+    text += render_gauges("flask_ai_db_pool", "Connection pool counters and sizes", [
+        ({"pool": name, "stat": stat}, value) for name, stats in pools.items() for stat, value in stats.items()
+    ])
+    text += render_gauges("flask_ai_query_guard_total", "Generated SQL guard outcomes", [
+        ({"outcome": outcome}, value) for outcome, value in guard_stats().items()
+    ], kind="counter")
+    backends = router.stats()
+    text += render_gauges("flask_ai_ollama_backend", "Per-backend router state", [
+        ({"backend": host, "stat": stat}, value) for host, stats in backends["backends"].items() for stat, value in stats.items()
+    ])
+    text += render_gauges("flask_ai_ollama_queue", "Router wait queue", [
+        ({"stat": stat}, backends[stat]) for stat in ("queued", "max_queue", "rejected", "queue_timeouts")
+    ])
+    text += render_gauges("flask_ai_cache", "Cache sizes and hit counters", [
+        ({"cache": name, "stat": stat}, value) for name, stats in caches.items() for stat, value in stats.items()
+    ])
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+@app.get("/pool")
+def pool():
+    return jsonify(pool_stats())
+
+@app.get("/guard")
+def guard():
+    return jsonify(guard_stats())
+
+@app.get("/ollama")
+def ollama():
+    return jsonify({"latency": latency_stats(), "router": router.stats()})
     
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
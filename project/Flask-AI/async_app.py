@@ -0,0 +1,230 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+
+import async_llm
+from columnar import format_error, result_format, to_columnar_json, to_arrow_ipc
+from db import guard_stats, statement_timeout_ms
+from llm import (
+    batch_error, candidate_count, invalidate_result_cache, invalidate_schema_cache,
+    result_cache_stats, schema_cache_stats, sql_cache_stats,
+)
+from ollama_client import OLLAMA_HOST, latency, latency_stats
+from metrics import TRACE_HEADER, stage_latency, start_trace, server_timing, render_histograms, render_gauges
+
+
+WARMUP = os.getenv("WARMUP", "true").lower() in ("1", "true", "yes")
+WARMUP_DB = os.getenv("WARMUP_DB", "flask_db")
+WARMUP_USER = os.getenv("WARMUP_USER", "admin")
+WARMUP_PASSWORD = os.getenv("WARMUP_PASSWORD", "secret")
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Startup completes before the server accepts connections
+    if WARMUP:
+        try:
+            result = await async_llm.warmup(WARMUP_DB, WARMUP_USER, WARMUP_PASSWORD)
+            logger.info("Warmup: %s tables, pool size %s", result["tables"], result["pool_size"])
+        except Exception as e:
+            logger.warning("Warmup failed: %s", e)
+    yield
+    await async_llm.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def trace_header(request: Request, call_next):
+    trace = start_trace()
+    response = await call_next(request)
+    wanted = TRACE_HEADER or request.query_params.get("trace", "false").lower() in ("1", "true", "yes")
+    if trace and wanted:
+        response.headers["Server-Timing"] = server_timing(trace)
+    return response
+
+
+def wants_stream(request, data):
+    stream = request.query_params.get("stream", data.get("stream", False))
+    return str(stream).lower() in ("1", "true", "yes")
+
+
+def ndjson_stream(events):
+    async def generate():
+        async for event in events:
+            yield json.dumps(event) + "\n"
+        yield json.dumps({"done": True}) + "\n"
+
+    return StreamingResponse(
+        generate(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.post("/generate")
+async def generate(request: Request):
+    data = await request.json()
+    prompt = data.get("prompt", "")
+
+    if wants_stream(request, data):
+        async def events():
+            async for token in async_llm.stream_prompt(prompt):
+                yield {"response": token}
+
+        return ndjson_stream(events())
+
+    response = await async_llm.generate_prompt(prompt)
+
+    return {"response": response}
+
+
+@app.get("/schemas")
+async def schemas(dbname: str = "flask_db", user: str = "admin", password: str = "secret", refresh: bool = False):
+    schemas_md = await async_llm.get_db_schema(dbname, user, password, refresh=refresh)
+    return {"schema": schemas_md}
+
+
+@app.post("/schemas/invalidate")
+async def invalidate_schemas(dbname: str = None):
+    return {"invalidated": invalidate_schema_cache(dbname), "cache": schema_cache_stats()}
+
+
+@app.post("/analyze")
+async def analyze(request: Request, dbname: str = "flask_db", user: str = "admin", password: str = "secret"):
+    data = await request.json()
+    question = data.get("question", "")
+    use_cache = str(data.get("cache", True)).lower() not in ("0", "false", "no")
+    use_result_cache = str(data.get("result_cache", use_cache)).lower() not in ("0", "false", "no")
+    statement_timeout = statement_timeout_ms(data.get("statement_timeout"))
+    candidates = candidate_count(data.get("candidates"))
+
+    if wants_stream(request, data):
+        async def events():
+            result = await async_llm.analyze_query(question, dbname, user, password, use_cache=use_cache,
+                                                   statement_timeout=statement_timeout, use_result_cache=use_result_cache,
+                                                   candidates=candidates)
+            yield {"data": result["data"], "row_count": result["row_count"], "truncated": result["truncated"],
+                   "cached": result["cached"], "candidates": result.get("candidates")}
+            async for token in async_llm.stream_analysis(question, result["context"]):
+                yield {"response": token}
+
+        return ndjson_stream(events())
+
+    # Checked up front so a bad format doesn't cost a query and an LLM call first
+    output = result_format(request.query_params.get("format", data.get("format")))
+    error = format_error(output)
+    if error:
+        return JSONResponse({"error": error[0]}, status_code=error[1])
+
+    result = await async_llm.analyze_query(question, dbname, user, password, use_cache=use_cache,
+                                           statement_timeout=statement_timeout, use_result_cache=use_result_cache,
+                                           candidates=candidates)
+    with_analysis = str(data.get("analysis", True)).lower() not in ("0", "false", "no")
+    analysis = await async_llm.response_analysis(question, result["context"]) if with_analysis else None
+    headers = {
+        "X-Result-Rows": str(result["row_count"]),
+        "X-Result-Truncated": str(result["truncated"]).lower(),
+        "X-Result-Cached": str(result["cached"]).lower(),
+        "X-SQL-Candidates": str(len(result.get("candidates") or [result["sql"]])),
+    }
+
+    # A failed query has no result set, only the error text in "data"
+    rows = result.get("result", {"columns": [], "types": [], "rows": []})
+    error = None if "result" in result else result["data"]
+    if output == "columnar":
+        return JSONResponse({
+            "analysis": analysis,
+            "sql": result["sql"],
+            "row_count": result["row_count"],
+            "truncated": result["truncated"],
+            "cached": result["cached"],
+            "error": error,
+            "candidates": result.get("candidates"),
+            "result": to_columnar_json(rows["columns"], rows["types"], rows["rows"]),
+        }, headers=headers)
+    if output == "arrow":
+        # Building the IPC stream is CPU work, keep it off the event loop
+        body = await asyncio.to_thread(to_arrow_ipc, rows["columns"], rows["types"], rows["rows"],
+                                       {"sql": result["sql"], "analysis": analysis or ""})
+        return Response(body, media_type="application/vnd.apache.arrow.stream", headers=headers)
+
+    return PlainTextResponse(analysis or "", headers=headers)
+
+
+@app.post("/results/invalidate")
+async def invalidate_results(table: str = None, dbname: str = None):
+    return {"invalidated": invalidate_result_cache(table, dbname), "cache": result_cache_stats()}
+
+
+@app.get("/sql-cache")
+async def sql_cache():
+    return sql_cache_stats()
+
+
+@app.post("/analyze/batch")
+async def analyze_batch(request: Request, dbname: str = "flask_db", user: str = "admin", password: str = "secret"):
+    data = await request.json()
+    questions = data.get("questions", [])
+    error = batch_error(questions)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    use_cache = str(data.get("cache", True)).lower() not in ("0", "false", "no")
+    with_analysis = str(data.get("analysis", True)).lower() not in ("0", "false", "no")
+    statement_timeout = statement_timeout_ms(data.get("statement_timeout"))
+
+    start = time.perf_counter()
+    results = await async_llm.analyze_batch(questions, dbname, user, password, use_cache=use_cache,
+                                            statement_timeout=statement_timeout, with_analysis=with_analysis,
+                                            candidates=candidate_count(data.get("candidates")))
+    return {"results": results, "elapsed": time.perf_counter() - start}
+
+
+@app.get("/metrics")
+async def metrics():
+    caches = {"schema": schema_cache_stats(), "sql": sql_cache_stats(), "result": result_cache_stats()}
+
+    text = render_histograms("flask_ai_stage_duration_seconds", "Pipeline stage latency in seconds", stage_latency, "stage")
+    text += render_histograms("flask_ai_ollama_duration_seconds", "Ollama call latency in seconds", latency, "call")
+    text += render_gauges("flask_ai_db_pool", "Connection pool counters and sizes", [
+        ({"pool": name, "stat": stat}, value) for name, stats in async_llm.pool_stats().items() for stat, value in stats.items()
+    ])
+    text += render_gauges("flask_ai_query_guard_total", "Generated SQL guard outcomes", [
+        ({"outcome": outcome}, value) for outcome, value in guard_stats().items()
+    ], kind="counter")
+    text += render_gauges("flask_ai_cache", "Cache sizes and hit counters", [
+        ({"cache": name, "stat": stat}, value) for name, stats in caches.items() for stat, value in stats.items()
+    ])
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+
+@app.get("/pool")
+async def pool():
+    return async_llm.pool_stats()
+
+
+@app.get("/guard")
+async def guard():
+    return guard_stats()
+
+
+@app.get("/ollama")
+async def ollama():
+    # No router here: every call goes to OLLAMA_HOST
+    return {"latency": latency_stats(), "host": OLLAMA_HOST}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # Same keep-alive and shutdown budget as gunicorn_conf.py, for running without gunicorn
+    uvicorn.run(app, host="0.0.0.0", port=5000, timeout_keep_alive=75, timeout_graceful_shutdown=120)
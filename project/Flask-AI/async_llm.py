@@ -0,0 +1,440 @@
+import asyncio
+import json
+import time
+
+import asyncpg
+import httpx
+
+from db import (
+    DB_HOST, DB_PORT, POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_TIMEOUT,
+    QUERY_MAX_COST, QUERY_STATEMENT_TIMEOUT_MS, QueryTimeout, check_plan_cost, credentials_key,
+    record_guard, statement_timeout_ms, vet_query,
+)
+# Caches and every decision that doesn't wait on I/O come from llm, so the two services can't drift apart
+from llm import (
+    SCHEMA_FINGERPRINT, SCHEMA_QUERY, SCHEMA_FINGERPRINT_QUERY, SCHEMA_TOP_N, SCHEMA_EMBED_MODEL,
+    SQL_CACHE_EMBED_MODEL, RESULT_MAX_ROWS, RESULT_FETCH_SIZE, BATCH_MAX_WORKERS, SQL_CANDIDATES,
+    sql_prompt, analysis_prompt, clean_sql,
+    cached_schema, unchanged_schema, store_schema,
+    lookup_sql, lookup_similar_sql, remember_sql,
+    candidate_prompts, distinct_candidates, explain_report, pick_candidate,
+    result_cache_key, cached_result, add_rows, query_result,
+    new_analysis, add_result, batch_entry,
+)
+from metrics import span
+from sql_cache import fingerprint
+from ollama_client import (
+    OLLAMA_HOST, OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT,
+    OLLAMA_RETRIES, OLLAMA_BACKOFF, OLLAMA_POOL_SIZE, latency,
+)
+
+RETRY_STATUSES = (500, 502, 503, 504)
+
+_client = None
+_pools = {}
+_pools_lock = asyncio.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            base_url=OLLAMA_HOST,
+            timeout=httpx.Timeout(OLLAMA_READ_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=OLLAMA_POOL_SIZE, max_keepalive_connections=OLLAMA_POOL_SIZE),
+        )
+    return _client
+
+
+async def get_pool(dbname, user, password, host=DB_HOST, port=DB_PORT):
+    key = credentials_key(dbname, user, password, host, port)
+    async with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = await asyncpg.create_pool(
+                database=dbname, user=user, password=password, host=host, port=port,
+                min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+            )
+            _pools[key] = pool
+        return pool
+
+
+async def warmup(dbname="flask_db", user="admin", password="secret", host=DB_HOST, port=DB_PORT):
+    pool = await get_pool(dbname, user, password, host, port)
+    index = await get_schema_index(dbname, user, password, host, port)
+    if SCHEMA_EMBED_MODEL and index.table_embeddings is None:
+        documents = index.documents()
+        index.set_embeddings(dict(zip(documents, await embed_batch(list(documents.values()), SCHEMA_EMBED_MODEL))))
+    return {"tables": len(index.tables), "pool_size": pool.get_size()}
+
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    async with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    await asyncio.gather(*(pool.close() for pool in pools))
+
+
+async def get_schema_index(dbname, user, password, host=DB_HOST, port=DB_PORT, refresh=False):
+    key = credentials_key(dbname, user, password, host, port)
+
+    if not refresh:
+        cached = cached_schema(key)
+        if cached is not None:
+            return cached
+
+    pool = await get_pool(dbname, user, password, host, port)
+    async with pool.acquire(timeout=POOL_TIMEOUT) as conn:
+        catalog_fingerprint = None
+        if SCHEMA_FINGERPRINT:
+            catalog_fingerprint = await conn.fetchval(SCHEMA_FINGERPRINT_QUERY)
+            unchanged = unchanged_schema(key, catalog_fingerprint, refresh)
+            if unchanged is not None:
+                return unchanged
+
+        rows = await conn.fetch(SCHEMA_QUERY)
+
+    return store_schema(key, (tuple(row) for row in rows), catalog_fingerprint)
+
+
+async def get_db_schema(dbname, user, password, host=DB_HOST, port=DB_PORT, refresh=False):
+    try:
+        return (await get_schema_index(dbname, user, password, host, port, refresh)).markdown()
+
+    except Exception as e:
+        return f"Error: {e}"
+
+
+async def relevant_schema(question, index):
+    question_embedding = None
+
+    if SCHEMA_EMBED_MODEL and len(index) > SCHEMA_TOP_N > 0:
+        try:
+            if index.table_embeddings is None:
+                documents = index.documents()
+                vectors = await embed_batch(list(documents.values()), SCHEMA_EMBED_MODEL)
+                index.set_embeddings(dict(zip(documents, vectors)))
+            question_embedding = await embed(question, SCHEMA_EMBED_MODEL)
+        except Exception:
+            question_embedding = None
+
+    return index.markdown(index.select(question, SCHEMA_TOP_N, question_embedding))
+
+
+async def _post_generate(payload):
+    for attempt in range(OLLAMA_RETRIES + 1):
+        try:
+            response = await get_client().post("/api/generate", json=payload)
+            if response.status_code not in RETRY_STATUSES or attempt == OLLAMA_RETRIES:
+                return response
+        except httpx.TransportError:
+            if attempt == OLLAMA_RETRIES:
+                raise
+        await asyncio.sleep(OLLAMA_BACKOFF * 2 ** attempt)
+
+
+async def generate_prompt(prompt, model="llama3.2", options=None):
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "stream": False
+    }
+    if options:
+        payload["options"] = options
+
+    try:
+        with latency["generate"].time():
+            response = await _post_generate(payload)
+            response.raise_for_status()
+        return response.json()["response"]
+
+    except Exception as e:
+        return f"Error: {e}"
+
+
+async def stream_prompt(prompt, model="llama3.2"):
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "stream": True
+    }
+
+    start = time.perf_counter()
+    first_token = True
+    try:
+        async with get_client().stream("POST", "/api/generate", json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if chunk.get("error"):
+                    raise RuntimeError(chunk["error"])
+                if chunk.get("response"):
+                    if first_token:
+                        latency["stream_first_token"].observe(time.perf_counter() - start)
+                        first_token = False
+                    yield chunk["response"]
+                if chunk.get("done"):
+                    break
+
+    except Exception as e:
+        yield f"Error: {e}"
+    finally:
+        latency["stream_total"].observe(time.perf_counter() - start)
+
+
+async def embed(text, model=SQL_CACHE_EMBED_MODEL):
+    response = await get_client().post("/api/embeddings", json={"model": model, "prompt": text})
+    response.raise_for_status()
+    return response.json()["embedding"]
+
+
+async def embed_batch(texts, model=SQL_CACHE_EMBED_MODEL):
+    response = await get_client().post("/api/embed", json={"model": model, "input": texts})
+    response.raise_for_status()
+    return response.json()["embeddings"]
+
+
+async def default_schema_index():
+    dbname, user, password = "flask_db", "admin", "secret"
+    return await get_schema_index(dbname, user, password)
+
+
+async def question_schema(question, index=None):
+    with span("schema"):
+        try:
+            if index is None:
+                index = await default_schema_index()
+            return await relevant_schema(question, index)
+        except Exception as e:
+            return f"Error: {e}"
+
+
+async def cached_sql(question, schema_fingerprint):
+    cached = lookup_sql(question, schema_fingerprint)
+    if cached is not None or not SQL_CACHE_EMBED_MODEL:
+        return cached, None
+
+    try:
+        embedding = await embed(question)
+    except Exception:
+        return None, None
+    return lookup_similar_sql(schema_fingerprint, embedding), embedding
+
+
+async def generate_sql(question, use_cache=True, index=None):
+    schema = await question_schema(question, index)
+
+    with span("generate_sql"):
+        schema_fingerprint = fingerprint(schema)
+        embedding = None
+
+        if use_cache:
+            cached, embedding = await cached_sql(question, schema_fingerprint)
+            if cached is not None:
+                return cached
+
+        response = await generate_prompt(sql_prompt(question, schema))
+
+        if use_cache:
+            remember_sql(question, schema, response, embedding)
+        return response
+
+
+async def generate_sql_candidates(question, schema, n):
+    return distinct_candidates(await asyncio.gather(*(
+        generate_prompt(prompt, options=options) for prompt, options in candidate_prompts(question, schema, n)
+    )))
+
+
+async def guard_transaction(conn, query, statement_timeout=QUERY_STATEMENT_TIMEOUT_MS, max_cost=QUERY_MAX_COST):
+    """asyncpg counterpart of db.guard_transaction; run it first inside a read-only transaction."""
+    vet_query(query)
+    await conn.execute(f"SET LOCAL statement_timeout = {int(statement_timeout)}")
+    plan = json.loads(await conn.fetchval("EXPLAIN (FORMAT JSON) " + query))
+    check_plan_cost(plan, max_cost)
+    return plan
+
+
+async def query_deadline(awaitable, timeout_ms=QUERY_STATEMENT_TIMEOUT_MS):
+    # statement_timeout covers one statement at a time; this covers the whole exchange.
+    # asyncpg cancels the running query server-side when the awaitable is cancelled.
+    timeout_ms = statement_timeout_ms(timeout_ms)
+    try:
+        return await asyncio.wait_for(awaitable, timeout_ms / 1000)
+    except asyncio.TimeoutError as e:
+        raise QueryTimeout(f"Query exceeded the {timeout_ms} ms time limit") from e
+
+
+async def explain_sql(query, dbname, user, password, host=DB_HOST, port=DB_PORT,
+                      statement_timeout=QUERY_STATEMENT_TIMEOUT_MS, max_cost=QUERY_MAX_COST):
+    async def explain(conn):
+        async with conn.transaction(readonly=True):
+            return await guard_transaction(conn, clean_sql(query), statement_timeout, max_cost)
+
+    try:
+        pool = await get_pool(dbname, user, password, host, port)
+        async with pool.acquire(timeout=POOL_TIMEOUT) as conn:
+            plan = await query_deadline(explain(conn), statement_timeout)
+    except Exception as e:
+        if isinstance(e, (asyncpg.exceptions.QueryCanceledError, QueryTimeout)):
+            record_guard("timeouts")
+        return explain_report(query, error=str(e))
+    return explain_report(query, plan)
+
+
+async def speculative_sql(question, dbname, user, password, host=DB_HOST, port=DB_PORT, candidates=SQL_CANDIDATES,
+                          statement_timeout=QUERY_STATEMENT_TIMEOUT_MS, max_cost=QUERY_MAX_COST, use_cache=True,
+                          index=None):
+    schema = await question_schema(question, index)
+    schema_fingerprint = fingerprint(schema)
+    embedding = None
+
+    with span("generate_sql"):
+        if use_cache:
+            cached, embedding = await cached_sql(question, schema_fingerprint)
+            if cached is not None:
+                return cached, []
+        queries = await generate_sql_candidates(question, schema, candidates)
+    if not queries:
+        return "Error: no SQL candidate could be generated", []
+
+    with span("validate_sql"):
+        reports = await asyncio.gather(*(
+            explain_sql(query, dbname, user, password, host, port, statement_timeout, max_cost) for query in queries
+        ))
+
+    best, valid = pick_candidate(queries, reports)
+    if use_cache and valid:
+        remember_sql(question, schema, best, embedding)
+    return best, list(reports)
+
+
+async def execute_query(query, dbname, user, password, host=DB_HOST, port=DB_PORT, max_rows=RESULT_MAX_ROWS,
+                        statement_timeout=QUERY_STATEMENT_TIMEOUT_MS, max_cost=QUERY_MAX_COST, use_cache=True):
+    query = clean_sql(query)
+    cache_key = result_cache_key(query, dbname, user, password, host, port, max_rows)
+
+    if use_cache:
+        cached = cached_result(cache_key)
+        if cached is not None:
+            return cached
+
+    rows = []
+    truncated = False
+
+    async def fetch(conn):
+        nonlocal truncated
+        # asyncpg cursors are server-side and need an open transaction
+        async with conn.transaction(readonly=True):
+            plan = await guard_transaction(conn, query, statement_timeout, max_cost)
+
+            statement = await conn.prepare(query)
+            cursor = await statement.cursor()
+            while not truncated:
+                chunk = await cursor.fetch(min(RESULT_FETCH_SIZE, max_rows + 1 - len(rows)))
+                if not chunk:
+                    break
+                truncated = add_rows(rows, chunk, max_rows)
+        return plan, statement.get_attributes()
+
+    pool = await get_pool(dbname, user, password, host, port)
+    try:
+        with span("execute"):
+            async with pool.acquire(timeout=POOL_TIMEOUT) as conn:
+                # One deadline for EXPLAIN, the cursor and every fetch together
+                plan, attributes = await query_deadline(fetch(conn), statement_timeout)
+                field_name = [attribute.name for attribute in attributes]
+                field_type = [attribute.type.name for attribute in attributes]
+
+    except (asyncpg.exceptions.QueryCanceledError, QueryTimeout):
+        record_guard("timeouts")
+        raise
+    except asyncpg.exceptions.ReadOnlySQLTransactionError:
+        record_guard("read_only_violations")
+        raise
+
+    return query_result(field_name, field_type, rows, truncated, max_rows, plan, cache_key if use_cache else None)
+
+
+async def analyze_query(question, dbname, user, password, host=DB_HOST, port=DB_PORT, use_cache=True, max_rows=RESULT_MAX_ROWS,
+                        statement_timeout=QUERY_STATEMENT_TIMEOUT_MS, index=None, use_result_cache=None,
+                        candidates=SQL_CANDIDATES):
+    if candidates > 1:
+        query, reports = await speculative_sql(question, dbname, user, password, host, port, candidates,
+                                               statement_timeout, use_cache=use_cache, index=index)
+    else:
+        query, reports = await generate_sql(question, use_cache=use_cache, index=index), None
+    analysis = new_analysis(query, reports)
+
+    if use_result_cache is None:
+        use_result_cache = use_cache
+
+    try:
+        result = await execute_query(query, dbname, user, password, host, port, max_rows, statement_timeout,
+                                     use_cache=use_result_cache)
+        add_result(analysis, result)
+
+    except Exception as e:
+        analysis["data"] = analysis["context"] = f"Error: {e}"
+
+    return analysis
+
+
+def pool_stats():
+    stats = {}
+    for (dbname, user, host, port, digest), pool in list(_pools.items()):
+        name = f"{user}@{host}:{port}/{dbname}"
+        size, idle = pool.get_size(), pool.get_idle_size()
+        stats[f"{name}#{digest[:8]}" if name in stats else name] = {
+            "size": size, "idle": idle, "in_use": size - idle, "max_size": pool.get_max_size(),
+        }
+    return stats
+
+
+async def analyze_response(question, dbname, user, password, host=DB_HOST, port=DB_PORT, use_cache=True):
+    return (await analyze_query(question, dbname, user, password, host, port, use_cache))["data"]
+
+
+async def response_analysis(question, response):
+    with span("response_analysis"):
+        return await generate_prompt(analysis_prompt(question, response))
+
+
+async def analyze_batch(questions, dbname, user, password, host=DB_HOST, port=DB_PORT, use_cache=True,
+                        statement_timeout=QUERY_STATEMENT_TIMEOUT_MS, with_analysis=True, candidates=SQL_CANDIDATES):
+    # One schema load for the whole batch instead of one per question
+    try:
+        index = await default_schema_index()
+    except Exception:
+        index = None
+
+    semaphore = asyncio.Semaphore(BATCH_MAX_WORKERS)
+
+    async def run(question):
+        async with semaphore:
+            start = time.perf_counter()
+            result = await analyze_query(question, dbname, user, password, host, port, use_cache,
+                                         statement_timeout=statement_timeout, index=index, candidates=candidates)
+            timings = {"query": time.perf_counter() - start}
+
+            if with_analysis:
+                analysis_start = time.perf_counter()
+                result["analysis"] = await response_analysis(question, result["context"])
+                timings["analysis"] = time.perf_counter() - analysis_start
+
+            timings["total"] = time.perf_counter() - start
+            return batch_entry(question, result, timings)
+
+    return await asyncio.gather(*(run(question) for question in questions))
+
+
+async def stream_analysis(question, response):
+    with span("response_analysis"):
+        async for token in stream_prompt(analysis_prompt(question, response)):
+            yield token
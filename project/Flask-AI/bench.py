@@ -0,0 +1,188 @@
+"""Load test for the Flask-AI service.
+
+By default starts a fake Ollama (fake_ollama.py) and the Flask app in-process,
+then drives /generate, /schemas and /analyze at the given concurrency against
+the Postgres configured through DB_HOST / DB_PORT. Pass --target to benchmark
+an already running service instead.
+
+    python bench.py --concurrency 16 --requests 200 --seed
+"""
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ENDPOINTS = {
+    "generate": ("POST", "/generate", {"prompt": "Summarize last quarter in one paragraph."}),
+    "schemas": ("GET", "/schemas", None),
+    "analyze": ("POST", "/analyze", {"question": "What are the customer names?"}),
+}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q * (len(values) - 1))))
+    return values[index]
+
+
+def parse_server_timing(header):
+    stages = {}
+    for part in filter(None, (item.strip() for item in (header or "").split(","))):
+        name, _, duration = part.partition(";dur=")
+        if duration:
+            stages[name] = float(duration) / 1000
+    return stages
+
+
+def seed_database(dbname, user, password, host, port, rows):
+    import psycopg2
+
+    conn = psycopg2.connect(dbname=dbname, user=user, password=password, host=host, port=port)
+    with conn, conn.cursor() as cursor:
+        cursor.execute("CREATE TABLE IF NOT EXISTS customers (id serial PRIMARY KEY, name text, city text, spend numeric)")
+        cursor.execute("TRUNCATE customers")
+        cursor.execute(
+            "INSERT INTO customers (name, city, spend) "
+            "SELECT 'customer ' || i, (ARRAY['Jakarta', 'Bandung', 'Surabaya'])[1 + i % 3], (i % 1000) / 10.0 "
+            "FROM generate_series(1, %s) AS i",
+            (rows,),
+        )
+    conn.close()
+
+
+def start_local_service(args):
+    from fake_ollama import FakeOllama
+
+    fake = FakeOllama(args.first_token_latency, args.tokens_per_second, args.tokens, args.sql)
+    ollama = fake.serve()
+    ollama_url = f"http://127.0.0.1:{ollama.server_address[1]}"
+
+    # Settings are read at import time, so they must be in place before app is imported
+    os.environ["OLLAMA_HOST"] = ollama_url
+    os.environ["OLLAMA_BACKENDS"] = ollama_url
+    os.environ["TRACE_HEADER"] = "true"
+
+    from werkzeug.serving import make_server
+    from app import app
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", [server, ollama]
+
+
+def run(target, endpoint, concurrency, total, params, no_cache):
+    method, path, body = ENDPOINTS[endpoint]
+    if body is not None and no_cache:
+        body = dict(body, cache=False)
+    local = threading.local()
+
+    def call(_):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            response = session.request(method, target + path, json=body, params=dict(params, trace=1), timeout=600)
+            ok = response.status_code < 400 and not response.text.startswith("Error")
+            stages = parse_server_timing(response.headers.get("Server-Timing"))
+        except requests.RequestException:
+            ok, stages = False, {}
+        return time.perf_counter() - start, ok, stages
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(call, range(total)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, _, _ in results]
+    stages = defaultdict(list)
+    for _, _, timings in results:
+        for stage, seconds in timings.items():
+            stages[stage].append(seconds)
+
+    return {
+        "endpoint": endpoint,
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": sum(1 for _, ok, _ in results if not ok),
+        "elapsed": elapsed,
+        "throughput": total / elapsed if elapsed else 0.0,
+        "latency": {
+            "mean": statistics.fmean(latencies),
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+        },
+        "stages": {
+            stage: {"mean": statistics.fmean(values), "p95": percentile(values, 0.95)}
+            for stage, values in stages.items()
+        },
+    }
+
+
+def print_report(report):
+    latency = report["latency"]
+    print(f"\n{report['endpoint']}: {report['requests']} requests @ concurrency {report['concurrency']}, "
+          f"{report['errors']} errors")
+    print(f"  throughput {report['throughput']:.2f} req/s over {report['elapsed']:.2f}s")
+    print(f"  latency    mean {latency['mean'] * 1000:.1f}ms  p50 {latency['p50'] * 1000:.1f}ms  "
+          f"p95 {latency['p95'] * 1000:.1f}ms  p99 {latency['p99'] * 1000:.1f}ms")
+    for stage, timing in report["stages"].items():
+        print(f"  {stage:<18} mean {timing['mean'] * 1000:.1f}ms  p95 {timing['p95'] * 1000:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", help="Base URL of a running service; skips the in-process app and fake Ollama")
+    parser.add_argument("--endpoints", default="generate,schemas,analyze")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--no-cache", action="store_true", help="Send cache=false so every /analyze does the full pipeline")
+    parser.add_argument("--json", action="store_true", help="Print the reports as JSON")
+    parser.add_argument("--dbname", default="flask_db")
+    parser.add_argument("--user", default="admin")
+    parser.add_argument("--password", default="secret")
+    parser.add_argument("--seed", action="store_true", help="Create and fill a customers table before the run")
+    parser.add_argument("--seed-rows", type=int, default=10_000)
+    parser.add_argument("--first-token-latency", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--sql", default="SELECT name, city, spend FROM customers")
+    args = parser.parse_args()
+
+    if args.seed:
+        from db import DB_HOST, DB_PORT
+        seed_database(args.dbname, args.user, args.password, DB_HOST, DB_PORT, args.seed_rows)
+
+    servers = []
+    target = args.target
+    if target is None:
+        target, servers = start_local_service(args)
+
+    params = {"dbname": args.dbname, "user": args.user, "password": args.password}
+    try:
+        reports = [
+            run(target.rstrip("/"), endpoint.strip(), args.concurrency, args.requests, params, args.no_cache)
+            for endpoint in args.endpoints.split(",")
+        ]
+    finally:
+        for server in servers:
+            server.shutdown()
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            print_report(report)
+
+
+if __name__ == "__main__":
+    main()
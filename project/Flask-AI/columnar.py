@@ -0,0 +1,110 @@
+import datetime
+import decimal
+import uuid
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# /analyze output formats; markdown is the original plain-text analysis response
+OUTPUT_FORMATS = ("markdown", "columnar", "arrow")
+
+# Postgres type OIDs as reported in psycopg2's cursor.description
+PG_TYPES = {
+    16: "bool",
+    20: "int8", 21: "int2", 23: "int4", 26: "oid",
+    700: "float4", 701: "float8", 1700: "numeric",
+    18: "char", 19: "name", 25: "text", 1042: "bpchar", 1043: "varchar",
+    1082: "date", 1083: "time", 1114: "timestamp", 1184: "timestamptz", 1186: "interval",
+    114: "json", 3802: "jsonb", 2950: "uuid", 17: "bytea",
+}
+
+INTEGER_TYPES = {"int2", "int4", "int8", "oid"}
+FLOAT_TYPES = {"float4", "float8", "numeric"}
+
+
+def pg_type_name(type_code):
+    return PG_TYPES.get(type_code, str(type_code))
+
+
+def result_format(requested=None):
+    # Missing, null and empty all mean the default
+    return str(requested or "markdown").strip().lower()
+
+
+def format_error(output):
+    """Why `output` can't be served, as (message, status), or None if it can."""
+    if output not in OUTPUT_FORMATS:
+        return f"Unknown format {output!r}, expected one of: {', '.join(OUTPUT_FORMATS)}", 400
+    if output == "arrow" and pa is None:
+        return "Arrow output needs pyarrow installed", 406
+    return None
+
+
+def _json_value(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, (bytes, memoryview)):
+        return bytes(value).hex()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value if isinstance(value, (list, dict)) else str(value)
+
+
+def _column_values(rows, count):
+    # One transpose over the rows instead of per-cell lookups
+    return list(zip(*rows)) if rows else [()] * count
+
+
+def to_columnar_json(columns, types, rows):
+    values = _column_values(rows, len(columns))
+    return {
+        "columns": [{"name": name, "type": type_name} for name, type_name in zip(columns, types)],
+        "data": [[_json_value(value) for value in column] for column in values],
+    }
+
+
+def _arrow_type(type_name):
+    if type_name == "bool":
+        return pa.bool_()
+    if type_name in INTEGER_TYPES:
+        return pa.int64()
+    if type_name in FLOAT_TYPES:
+        return pa.float64()
+    if type_name == "date":
+        return pa.date32()
+    if type_name == "timestamp":
+        return pa.timestamp("us")
+    if type_name == "timestamptz":
+        return pa.timestamp("us", tz="UTC")
+    return pa.string()
+
+
+def to_arrow_ipc(columns, types, rows, metadata=None):
+    if pa is None:
+        raise RuntimeError("Arrow output needs pyarrow installed")
+
+    arrays = []
+    for values, type_name in zip(_column_values(rows, len(columns)), types):
+        arrow_type = _arrow_type(type_name)
+        if arrow_type == pa.float64():
+            values = [None if value is None else float(value) for value in values]
+        elif arrow_type == pa.string():
+            values = [None if value is None else str(_json_value(value)) for value in values]
+        arrays.append(pa.array(values, type=arrow_type))
+
+    table = pa.Table.from_arrays(arrays, names=list(columns))
+    if metadata:
+        table = table.replace_schema_metadata({key: str(value) for key, value in metadata.items()})
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
@@ -0,0 +1,418 @@
+import hashlib
+import hmac
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.errors
+
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_PORT = int(os.getenv("DB_PORT", 5433))
+
+POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN", 1))
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX", 10))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+
+# Planner cost above which generated SQL is refused; 0 disables the EXPLAIN check
+QUERY_MAX_COST = float(os.getenv("QUERY_MAX_COST", 1_000_000))
+QUERY_STATEMENT_TIMEOUT_MS = int(os.getenv("QUERY_STATEMENT_TIMEOUT_MS", 30_000))
+
+
+def statement_timeout_ms(requested=None):
+    """Timeout for a caller-supplied value: callers may tighten it but never loosen it.
+
+    Postgres reads 0 as "no timeout", so zero, negative and unparsable values get the default.
+    """
+    try:
+        requested = int(requested)
+    except (TypeError, ValueError):
+        return QUERY_STATEMENT_TIMEOUT_MS
+    return QUERY_STATEMENT_TIMEOUT_MS if requested <= 0 else min(requested, QUERY_STATEMENT_TIMEOUT_MS)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class QueryRejected(Exception):
+    pass
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Thread-safe pool of psycopg2 connections for one (dbname, user, host, port)."""
+
+    def __init__(self, dbname, user, password, host=DB_HOST, port=DB_PORT,
+                 minconn=POOL_MIN_SIZE, maxconn=POOL_MAX_SIZE, timeout=POOL_TIMEOUT):
+        self.dsn = dict(dbname=dbname, user=user, password=password, host=host, port=port)
+        self.minconn = minconn
+        self.maxconn = max(maxconn, minconn, 1)
+        self.timeout = timeout
+
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "timeouts": 0,
+            "health_failures": 0,
+        }
+
+        for _ in range(minconn):
+            self._idle.append(self._connect())
+            self._size += 1
+
+    def _connect(self):
+        return psycopg2.connect(**self.dsn)
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def getconn(self):
+        start = time.monotonic()
+        waited = False
+
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    # Reserve the slot now, open the socket outside the lock
+                    self._size += 1
+                    conn = None
+                    break
+
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"No connection available after {self.timeout}s")
+                waited = True
+                self._cond.wait(remaining)
+
+            if waited:
+                self._stats["waits"] += 1
+                self._stats["wait_seconds"] += time.monotonic() - start
+
+        if conn is not None:
+            if self._is_healthy(conn):
+                with self._cond:
+                    self._stats["hits"] += 1
+                return conn
+            with self._cond:
+                self._stats["health_failures"] += 1
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+        # Either the pool had nothing idle or the idle connection was dead;
+        # the slot is still reserved for us either way.
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._stats["misses"] += 1
+        return conn
+
+    def putconn(self, conn, close=False):
+        if close or conn.closed:
+            self._discard(conn)
+            return
+
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            self._discard(conn)
+            return
+
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn in idle:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._size - len(self._idle)
+            stats["max_size"] = self.maxconn
+        return stats
+
+
+# Per-process salt, so the password digests kept in cache keys are useless outside it
+_CREDENTIALS_SALT = os.urandom(16)
+
+
+def credentials_key(dbname, user, password, host=DB_HOST, port=DB_PORT):
+    """Key for anything opened or cached under these credentials.
+
+    The password digest is part of the key so a wrong password never reuses a
+    pool or cache entry that was filled by a right one.
+    """
+    digest = hmac.new(_CREDENTIALS_SALT, (password or "").encode("utf-8"), hashlib.sha256).hexdigest()
+    return (dbname, user, host, port, digest)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(dbname, user, password, host=DB_HOST, port=DB_PORT):
+    key = credentials_key(dbname, user, password, host, port)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(dbname, user, password, host, port)
+            _pools[key] = pool
+        return pool
+
+
+@contextmanager
+def connection(dbname, user, password, host=DB_HOST, port=DB_PORT):
+    pool = get_pool(dbname, user, password, host, port)
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        # putconn rolls back and drops the connection if it's closed or broken
+        pool.putconn(conn)
+
+
+def pool_stats():
+    with _pools_lock:
+        pools = dict(_pools)
+    stats = {}
+    for (dbname, user, host, port, digest), pool in pools.items():
+        name = f"{user}@{host}:{port}/{dbname}"
+        # Same login with different passwords gets separate pools
+        stats[f"{name}#{digest[:8]}" if name in stats else name] = pool.stats()
+    return stats
+
+
+def close_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.closeall()
+
+
+_guard_stats = {"checked": 0, "rejected": 0, "timeouts": 0, "read_only_violations": 0}
+_guard_lock = threading.Lock()
+
+
+def record_guard(event):
+    with _guard_lock:
+        _guard_stats[event] += 1
+
+
+def guard_stats():
+    with _guard_lock:
+        return dict(_guard_stats)
+
+
+def record_query_error(error):
+    if isinstance(error, (psycopg2.errors.QueryCanceled, QueryTimeout)):
+        record_guard("timeouts")
+    elif isinstance(error, psycopg2.errors.ReadOnlySqlTransaction):
+        record_guard("read_only_violations")
+
+
+def check_plan_cost(plan, max_cost=QUERY_MAX_COST):
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    cost = plan[0]["Plan"]["Total Cost"]
+    record_guard("checked")
+    if max_cost and cost > max_cost:
+        record_guard("rejected")
+        raise QueryRejected(f"Estimated cost {cost:,.0f} exceeds the limit of {max_cost:,.0f}")
+    return cost
+
+
+def plan_relations(plan):
+    """Base tables the planner will read, views already expanded."""
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    relations = set()
+    nodes = [plan[0]["Plan"]]
+    while nodes:
+        node = nodes.pop()
+        if "Relation Name" in node:
+            relations.add(node["Relation Name"])
+        nodes.extend(node.get("Plans", []))
+    return relations
+
+
+# set_config(..., true) changes settings for the rest of the transaction, statement_timeout included
+_FORBIDDEN_FUNCTIONS = re.compile(r"\bset_config\b", re.IGNORECASE)
+_DOLLAR_TAG = re.compile(r"\$(?:[A-Za-z_][A-Za-z_0-9]*)?\$")
+
+
+def has_multiple_statements(query):
+    """True if `query` has a ";" outside literals, identifiers and comments.
+
+    The scan follows Postgres' lexer closely enough that anything it treats as
+    quoted, Postgres does too; where they could disagree it errs towards True.
+    """
+    i, length = 0, len(query)
+    while i < length:
+        char = query[i]
+        if query.startswith("--", i):
+            end = query.find("\n", i)
+            i = length if end < 0 else end + 1
+        elif query.startswith("/*", i):
+            # Block comments nest in Postgres
+            depth, i = 1, i + 2
+            while i < length and depth:
+                if query.startswith("/*", i):
+                    depth, i = depth + 1, i + 2
+                elif query.startswith("*/", i):
+                    depth, i = depth - 1, i + 2
+                else:
+                    i += 1
+            if depth:
+                return True
+        elif char in ("'", '"'):
+            # E'...' strings take backslash escapes; doubled quotes escape in every form
+            escapes = char == "'" and i > 0 and query[i - 1] in "eE" and not _is_identifier_char(query, i - 2)
+            i += 1
+            while i < length:
+                if escapes and query[i] == "\\":
+                    i += 2
+                elif query[i] == char:
+                    if query.startswith(char * 2, i):
+                        i += 2
+                    else:
+                        break
+                else:
+                    i += 1
+            if i >= length:
+                return True
+            i += 1
+        elif char == "$" and not _is_identifier_char(query, i - 1) and _DOLLAR_TAG.match(query, i):
+            tag = _DOLLAR_TAG.match(query, i).group()
+            end = query.find(tag, i + len(tag))
+            if end < 0:
+                return True
+            i = end + len(tag)
+        elif char == ";":
+            return True
+        else:
+            i += 1
+    return False
+
+
+def _is_identifier_char(query, i):
+    return i >= 0 and (query[i].isalnum() or query[i] in "_$")
+
+
+def vet_query(query):
+    """Refuse SQL that could escape the guard before it reaches the server."""
+    # cursor.execute runs every statement in the string, so a "; COMMIT; ..." would
+    # end the read-only transaction and run whatever follows outside of it
+    if has_multiple_statements(query):
+        record_guard("rejected")
+        raise QueryRejected("Only a single SQL statement is allowed")
+    # Matched anywhere, literals included; a false positive only costs a regenerated query
+    if _FORBIDDEN_FUNCTIONS.search(query):
+        record_guard("rejected")
+        raise QueryRejected("set_config is not allowed in generated SQL")
+
+
+def guard_transaction(cursor, query, statement_timeout=QUERY_STATEMENT_TIMEOUT_MS, max_cost=QUERY_MAX_COST):
+    """Make the current transaction read-only and time-limited, then vet and return the query plan."""
+    vet_query(query)
+    # Must be the first statements of the transaction; both revert on rollback
+    cursor.execute("SET TRANSACTION READ ONLY")
+    cursor.execute("SET LOCAL statement_timeout = %s", (int(statement_timeout),))
+    cursor.execute("EXPLAIN (FORMAT JSON) " + query)
+    plan = cursor.fetchone()[0]
+    check_plan_cost(plan, max_cost)
+    return plan
+
+
+@contextmanager
+def query_deadline(conn, timeout_ms=QUERY_STATEMENT_TIMEOUT_MS):
+    """Cancel whatever `conn` runs inside the block once `timeout_ms` has passed.
+
+    statement_timeout bounds each statement on its own, and every FETCH from a
+    server-side cursor is a new statement, so it can't bound a whole request.
+    """
+    timeout_ms = statement_timeout_ms(timeout_ms)
+    done = threading.Event()
+    expired = threading.Event()
+    lock = threading.Lock()
+
+    def watch():
+        if done.wait(timeout_ms / 1000):
+            return
+        expired.set()
+        # The server drops a cancel that arrives between two statements, so keep
+        # sending them until the block gives up
+        while True:
+            with lock:
+                if done.is_set():
+                    return
+                try:
+                    conn.cancel()
+                except psycopg2.Error:
+                    return
+            if done.wait(0.05):
+                return
+
+    threading.Thread(target=watch, name="query-deadline", daemon=True).start()
+    try:
+        yield
+    except psycopg2.errors.QueryCanceled as e:
+        if expired.is_set():
+            raise QueryTimeout(f"Query exceeded the {timeout_ms} ms time limit") from e
+        raise
+    finally:
+        with lock:
+            done.set()
+        if expired.is_set():
+            # A cancel may still be on its way; keep it away from the next borrower
+            conn.close()
@@ -0,0 +1,120 @@
+"""Minimal stand-in for the Ollama HTTP API, for load tests without a GPU.
+
+Serves /api/generate (blocking and streamed), /api/embeddings and /api/embed with
+a configurable time-to-first-token and token rate.
+"""
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ("revenue customers grew steadily across regions while churn stayed flat and "
+         "the top segment accounted for most of the order volume this quarter").split()
+
+
+class FakeOllama:
+    def __init__(self, first_token_latency=0.2, tokens_per_second=50.0, tokens=100,
+                 sql="SELECT * FROM customers", embedding_dim=64):
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.tokens = tokens
+        self.sql = sql
+        self.embedding_dim = embedding_dim
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def completion(self, prompt):
+        # The SQL prompt asks for a query; everything else gets filler prose
+        if "Generate a SQL query" in prompt:
+            return [self.sql]
+        return [WORDS[i % len(WORDS)] + " " for i in range(self.tokens)]
+
+    def embedding(self, text):
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        return [(digest[i % len(digest)] - 128) / 128 for i in range(self.embedding_dim)]
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, payload):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                with fake._lock:
+                    fake.requests += 1
+
+                if self.path == "/api/embeddings":
+                    return self._send_json({"embedding": fake.embedding(payload.get("prompt", ""))})
+                if self.path == "/api/embed":
+                    texts = payload.get("input", [])
+                    texts = [texts] if isinstance(texts, str) else texts
+                    return self._send_json({"embeddings": [fake.embedding(text) for text in texts]})
+                if self.path != "/api/generate":
+                    self.send_error(404)
+                    return
+
+                tokens = fake.completion(payload.get("prompt", ""))
+                delay = 1 / fake.tokens_per_second if fake.tokens_per_second else 0
+                time.sleep(fake.first_token_latency)
+
+                if not payload.get("stream", True):
+                    time.sleep(delay * (len(tokens) - 1))
+                    return self._send_json({"model": payload.get("model"), "response": "".join(tokens), "done": True})
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for i, token in enumerate(tokens):
+                    if i:
+                        time.sleep(delay)
+                    self._chunk({"model": payload.get("model"), "response": token, "done": False})
+                self._chunk({"model": payload.get("model"), "response": "", "done": True})
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _chunk(self, payload):
+                data = (json.dumps(payload) + "\n").encode("utf-8")
+                self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+    def serve(self, host="127.0.0.1", port=0):
+        server = ThreadingHTTPServer((host, port), self.handler())
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--first-token-latency", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--sql", default="SELECT * FROM customers")
+    args = parser.parse_args()
+
+    fake = FakeOllama(args.first_token_latency, args.tokens_per_second, args.tokens, args.sql)
+    server = fake.serve("0.0.0.0", args.port)
+    print(f"Fake Ollama listening on :{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,95 @@
+"""Production server profile for the Flask app.
+
+    gunicorn -c gunicorn_conf.py app:app
+
+Runs threaded workers so one worker can hold several slow LLM calls open, and
+warms the DB pool and schema cache before any worker accepts traffic. Every
+setting can be overridden through the GUNICORN_* and WARMUP_* variables below.
+
+gunicorn has no per-request time limit for these workers. A request is bounded by
+the app's own timeouts: OLLAMA_CONNECT_TIMEOUT and OLLAMA_READ_TIMEOUT on every
+Ollama call (retried up to OLLAMA_RETRIES times), and QUERY_STATEMENT_TIMEOUT_MS
+for the whole of each SQL query.
+
+The async app runs under the same profile with an ASGI worker class:
+
+    GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn -c gunicorn_conf.py async_app:app
+"""
+import multiprocessing
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+
+# Requests mostly wait on Ollama and Postgres, so threads carry the concurrency;
+# keep DB_POOL_MAX at or above the thread count so threads don't queue on the pool
+workers = int(os.getenv("GUNICORN_WORKERS", min(multiprocessing.cpu_count(), 4)))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+
+# Worker heartbeat, not a request limit: the master restarts a worker whose process
+# stops checking in for this long. A gthread request that is merely slow keeps
+# running past it; see the docstring for what actually bounds one.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 300))
+# In-flight requests get this long to finish after SIGTERM
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 120))
+# Longer than a typical load balancer idle timeout so the proxy closes first
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 75))
+
+# Recycle workers now and then to cap slow leaks; jitter avoids all of them restarting at once
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 200))
+
+# Import the app once in the master so workers fork with the schema cache already filled
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() in ("1", "true", "yes")
+
+WARMUP = os.getenv("WARMUP", "true").lower() in ("1", "true", "yes")
+WARMUP_DB = os.getenv("WARMUP_DB", "flask_db")
+WARMUP_USER = os.getenv("WARMUP_USER", "admin")
+WARMUP_PASSWORD = os.getenv("WARMUP_PASSWORD", "secret")
+
+accesslog = os.getenv("GUNICORN_ACCESSLOG", "-")
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOGLEVEL", "info")
+
+
+def _warmup(log):
+    # The ASGI app warms its own asyncpg pool in its lifespan handler
+    if not WARMUP or "uvicorn" in worker_class.lower():
+        return
+    try:
+        import llm
+
+        result = llm.warmup(WARMUP_DB, WARMUP_USER, WARMUP_PASSWORD)
+        log.info("Warmup: %s tables, pool %s", result["tables"], result["pool"])
+    except Exception as e:
+        # A cold cache is slower, not broken; don't keep the server from starting
+        log.warning("Warmup failed: %s", e)
+
+
+def _close_connections():
+    if "uvicorn" in worker_class.lower():
+        return
+
+    import ollama_client
+    from db import close_pools
+
+    close_pools()
+    ollama_client.close_session()
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    _warmup(server.log)
+    # Sockets must not be shared across fork; each worker opens its own below
+    _close_connections()
+
+
+def post_worker_init(worker):
+    # Runs before the worker starts accepting; the schema cache is already warm
+    # when preloaded, so this mostly opens the worker's own pool connections
+    _warmup(worker.log)
+
+
+def worker_exit(server, worker):
+    _close_connections()
@@ -1,58 +1,258 @@
-import requests 
-import psycopg2
+import contextvars
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import ollama_client
+from cache import TTLCache
+from columnar import pg_type_name
+from db import (
+    connection, credentials_key, get_pool, guard_transaction, plan_relations, query_deadline, record_query_error,
+    DB_HOST, DB_PORT, QUERY_MAX_COST, QUERY_STATEMENT_TIMEOUT_MS,
+)
+from metrics import span
+from router import router
+from sql_cache import SQLCache, fingerprint, normalize_sql
+from schema_index import SchemaIndex
+from summarize import estimate_tokens, summarize_result
 
-def get_db_schema(dbname, user, password, host='localhost', port=5433):
-    try:
-        conn = psycopg2.connect(dbname=dbname, user=user, password=password, host=host, port=port)
-        cursor = conn.cursor()
-        
-        query = """
-            SELECT table_name, column_name, data_type
-            FROM information_schema.columns
-            WHERE table_schema = 'public'
-            ORDER BY table_name, ordinal_position
-        """
-        
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        conn.close()
-        
-        if not rows:
-            return "No tables found in the database."
-        
-        markdown = "|Table name | Column name | Data type |\n| --------- | ----------- | ---------- | \n"
-        
-        for row in rows:
-            markdown += f"|{row[0]} | {row[1]} | {row[2]} |\n"
+SCHEMA_CACHE_TTL = float(os.getenv("SCHEMA_CACHE_TTL", 3600))
+SCHEMA_FINGERPRINT = os.getenv("SCHEMA_FINGERPRINT", "false").lower() in ("1", "true", "yes")
+# Only the SCHEMA_TOP_N tables most relevant to the question go into the SQL prompt; 0 sends all
+SCHEMA_TOP_N = int(os.getenv("SCHEMA_TOP_N", 10))
+# Ollama embedding model for ranking tables by similarity; empty uses keywords only
+SCHEMA_EMBED_MODEL = os.getenv("SCHEMA_EMBED_MODEL", "")
+
+SQL_CACHE_SIZE = int(os.getenv("SQL_CACHE_SIZE", 512))
+SQL_CACHE_TTL = float(os.getenv("SQL_CACHE_TTL", 86400))
+# Ollama embedding model used to match near-duplicate questions; empty disables it
+SQL_CACHE_EMBED_MODEL = os.getenv("SQL_CACHE_EMBED_MODEL", "")
+SQL_CACHE_SIMILARITY = float(os.getenv("SQL_CACHE_SIMILARITY", 0.92))
+
+# Worker threads shared by all /analyze/batch requests
+BATCH_MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", 8))
+# Larger batches are refused rather than queued behind everyone else's
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", 50))
+
+RESULT_MAX_ROWS = int(os.getenv("RESULT_MAX_ROWS", 1000))
+RESULT_FETCH_SIZE = int(os.getenv("RESULT_FETCH_SIZE", 500))
+
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 256))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", 300))
+
+# Speculative SQL: candidates generated per question when a request asks for more than one
+SQL_CANDIDATES = int(os.getenv("SQL_CANDIDATES", 1))
+SQL_CANDIDATES_MAX = int(os.getenv("SQL_CANDIDATES_MAX", 6))
+SQL_CANDIDATE_TEMPERATURES = [float(t) for t in os.getenv("SQL_CANDIDATE_TEMPERATURES", "0,0.4,0.8").split(",")]
+SQL_CANDIDATE_HINTS = (
+    "",
+    "Prefer the simplest query that answers the question.",
+    "Select only the columns needed and use explicit JOIN ... ON clauses.",
+)
+
+# Results larger than this are summarized before being sent to response_analysis
+ANALYSIS_TOKEN_BUDGET = int(os.getenv("ANALYSIS_TOKEN_BUDGET", 2000))
+ANALYSIS_TOP_K = int(os.getenv("ANALYSIS_TOP_K", 5))
+
+# The last column is the table a foreign key on the column points at, if any
+SCHEMA_QUERY = """
+    SELECT table_name, column_name, data_type,
+           obj_description(format('%I.%I', table_schema, table_name)::regclass, 'pg_class'),
+           col_description(format('%I.%I', table_schema, table_name)::regclass, ordinal_position),
+           (SELECT ref.relname
+            FROM pg_constraint con
+            JOIN pg_class ref ON ref.oid = con.confrelid
+            WHERE con.contype = 'f'
+              AND con.conrelid = format('%I.%I', table_schema, table_name)::regclass
+              AND ordinal_position::int2 = ANY (con.conkey)
+            LIMIT 1)
+    FROM information_schema.columns
+    WHERE table_schema = 'public'
+    ORDER BY table_name, ordinal_position
+"""
+
+# Reads pg_attribute directly, which is much cheaper than the information_schema
+# views. Any DDL on a public table rewrites its pg_attribute rows, so xmin changes.
+# Foreign keys live in pg_constraint, which column DDL doesn't touch, so it's hashed too.
+SCHEMA_FINGERPRINT_QUERY = """
+    SELECT md5(
+        coalesce((SELECT string_agg(a.attrelid::text || '.' || a.attnum || '.' || a.xmin::text, ','
+                                    ORDER BY a.attrelid, a.attnum)
+                  FROM pg_attribute a
+                  JOIN pg_class c ON c.oid = a.attrelid
+                  JOIN pg_namespace n ON n.oid = c.relnamespace
+                  WHERE n.nspname = 'public' AND c.relkind IN ('r', 'v', 'm', 'p', 'f') AND a.attnum > 0), '')
+        || '/' ||
+        coalesce((SELECT string_agg(con.oid::text || '.' || con.xmin::text, ',' ORDER BY con.oid)
+                  FROM pg_constraint con
+                  JOIN pg_namespace n ON n.oid = con.connamespace
+                  WHERE n.nspname = 'public' AND con.contype = 'f'), ''))
+"""
+
+# async_llm shares these caches through the helper functions below
+
+# credentials_key(...) -> SchemaIndex, expires after SCHEMA_CACHE_TTL
+_schema_cache = TTLCache(maxsize=64, ttl=SCHEMA_CACHE_TTL)
+# credentials_key(...) -> (fingerprint, SchemaIndex), survives TTL expiry
+_schema_fingerprints = {}
+
+_sql_cache = SQLCache(maxsize=SQL_CACHE_SIZE, ttl=SQL_CACHE_TTL, similarity=SQL_CACHE_SIMILARITY)
+
+# (normalized sql, *credentials_key(...), max_rows) -> execute_query result
+_result_cache = TTLCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+
+_batch_executor = None
+_batch_executor_lock = threading.Lock()
+
+# Kept apart from the batch executor so batch workers can speculate without starving each other
+_candidate_executor = None
+_candidate_executor_lock = threading.Lock()
+
+def get_schema_index(dbname, user, password, host=DB_HOST, port=DB_PORT, refresh=False):
+    key = credentials_key(dbname, user, password, host, port)
+    
+    if not refresh:
+        cached = cached_schema(key)
+        if cached is not None:
+            return cached
+    
+    with connection(dbname, user, password, host, port) as conn:
+        with conn.cursor() as cursor:
+            catalog_fingerprint = None
+            if SCHEMA_FINGERPRINT:
+                cursor.execute(SCHEMA_FINGERPRINT_QUERY)
+                catalog_fingerprint = cursor.fetchone()[0]
+                unchanged = unchanged_schema(key, catalog_fingerprint, refresh)
+                if unchanged is not None:
+                    return unchanged
             
-        return markdown
+            cursor.execute(SCHEMA_QUERY)
+            rows = cursor.fetchall()
+    
+    return store_schema(key, rows, catalog_fingerprint)
+
+def cached_schema(key):
+    return _schema_cache.get(key)
+
+def unchanged_schema(key, catalog_fingerprint, refresh=False):
+    """The index built for `key` if the catalog hasn't changed since, re-cached for another TTL."""
+    previous = _schema_fingerprints.get(key)
+    if refresh or not previous or previous[0] != catalog_fingerprint:
+        return None
+    _schema_cache.set(key, previous[1])
+    return previous[1]
+
+def store_schema(key, rows, catalog_fingerprint=None):
+    index = SchemaIndex(rows)
+    _schema_cache.set(key, index)
+    if catalog_fingerprint is not None:
+        _schema_fingerprints[key] = (catalog_fingerprint, index)
+    return index
+
+def get_db_schema(dbname, user, password, host=DB_HOST, port=DB_PORT, refresh=False):
+    try:
+        return get_schema_index(dbname, user, password, host, port, refresh).markdown()
         
     except Exception as e:
         return f"Error: {e}"
+
+def relevant_schema(question, index):
+    question_embedding = None
     
-def generate_prompt(prompt, model="llama3.2", host="http://localhost:11434/"):
-    url = f"{host}/api/generate"
+    if SCHEMA_EMBED_MODEL and len(index) > SCHEMA_TOP_N > 0:
+        try:
+            if index.table_embeddings is None:
+                documents = index.documents()
+                vectors = embed_batch(list(documents.values()), SCHEMA_EMBED_MODEL)
+                index.set_embeddings(dict(zip(documents, vectors)))
+            question_embedding = embed(question, SCHEMA_EMBED_MODEL)
+        except Exception:
+            question_embedding = None
+    
+    return index.markdown(index.select(question, SCHEMA_TOP_N, question_embedding))
+
+def invalidate_schema_cache(dbname=None):
+    def matches(key, value=None):
+        return dbname is None or key[0] == dbname
+    
+    for key in [key for key in list(_schema_fingerprints) if matches(key)]:
+        _schema_fingerprints.pop(key, None)
+    return _schema_cache.invalidate_where(matches)
+
+def schema_cache_stats():
+    return _schema_cache.stats()
+    
+def ollama_backend(host=None):
+    # An explicit host bypasses the router; otherwise take a slot on the least busy backend
+    return nullcontext(host.rstrip("/")) if host else router.acquire()
+
+def generate_prompt(prompt, model="llama3.2", host=None, options=None):
     payload = {
         "model": model,
         "prompt": prompt,
         "stream": False
     }
+    if options:
+        payload["options"] = options
     
     try:
-        response = requests.post(url, json=payload)
-        response.raise_for_status()
-        data = response.json()["response"]
+        with ollama_backend(host) as base, ollama_client.latency["generate"].time():
+            response = ollama_client.post(f"{base}/api/generate", json=payload)
+            response.raise_for_status()
+            data = response.json()["response"]
         return data
         
     except Exception as e:
         return f"Error: {e}"
+
+def stream_prompt(prompt, model="llama3.2", host=None):
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "stream": True
+    }
     
-def generate_sql(question):
-    dbname, user, password = "flask_db", "admin", "secret"
-    
-    schema = get_db_schema(dbname, user, password)
+    start = time.perf_counter()
+    first_token = True
+    try:
+        with ollama_backend(host) as base, ollama_client.post(f"{base}/api/generate", json=payload, stream=True) as response:
+            response.raise_for_status()
+            # Ollama streams one JSON object per line until "done" is true
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if chunk.get("error"):
+                    raise RuntimeError(chunk["error"])
+                if chunk.get("response"):
+                    if first_token:
+                        ollama_client.latency["stream_first_token"].observe(time.perf_counter() - start)
+                        first_token = False
+                    yield chunk["response"]
+                if chunk.get("done"):
+                    break
+                    
+    except Exception as e:
+        yield f"Error: {e}"
+    finally:
+        ollama_client.latency["stream_total"].observe(time.perf_counter() - start)
     
-    prompt = f"""
+def embed(text, model=SQL_CACHE_EMBED_MODEL, host=None):
+    with ollama_backend(host) as base:
+        response = ollama_client.post(f"{base}/api/embeddings", json={"model": model, "prompt": text})
+        response.raise_for_status()
+        return response.json()["embedding"]
+
+def embed_batch(texts, model=SQL_CACHE_EMBED_MODEL, host=None):
+    with ollama_backend(host) as base:
+        response = ollama_client.post(f"{base}/api/embed", json={"model": model, "input": texts})
+        response.raise_for_status()
+        return response.json()["embeddings"]
+
+def sql_prompt(question, schema, hint=""):
+    return f"""
         Act as Data Analyst senior, you will help junior on providing SQL queries.
         
         Generate a SQL query that answer the following question:
@@ -64,37 +264,361 @@ def generate_sql(question):
         {schema} 
         
         Return only SQL query in plain text
+        {hint}
+    """
+
+def default_schema_index():
+    dbname, user, password = "flask_db", "admin", "secret"
+    return get_schema_index(dbname, user, password)
+
+def question_schema(question, index=None):
+    with span("schema"):
+        try:
+            if index is None:
+                index = default_schema_index()
+            return relevant_schema(question, index)
+        except Exception as e:
+            return f"Error: {e}"
+
+def lookup_sql(question, schema_fingerprint):
+    return _sql_cache.get(question, schema_fingerprint)
+
+def lookup_similar_sql(schema_fingerprint, embedding):
+    return _sql_cache.get_similar(schema_fingerprint, embedding)
+
+def remember_sql(question, schema, query, embedding=None):
+    # Neither a failed generation nor one made without the schema is worth reusing
+    if not query.startswith("Error:") and not schema.startswith("Error:"):
+        _sql_cache.set(question, fingerprint(schema), query, embedding)
+
+def cached_sql(question, schema_fingerprint):
+    """Cached SQL for the question (exact, then similar), plus its embedding for storing a miss."""
+    cached = lookup_sql(question, schema_fingerprint)
+    if cached is not None or not SQL_CACHE_EMBED_MODEL:
+        return cached, None
+    
+    try:
+        embedding = embed(question)
+    except Exception:
+        return None, None
+    return lookup_similar_sql(schema_fingerprint, embedding), embedding
+
+def generate_sql(question, use_cache=True, index=None):
+    schema = question_schema(question, index)
+    
+    with span("generate_sql"):
+        schema_fingerprint = fingerprint(schema)
+        embedding = None
+    
+        if use_cache:
+            cached, embedding = cached_sql(question, schema_fingerprint)
+            if cached is not None:
+                return cached
+    
+        response = generate_prompt(sql_prompt(question, schema))
+    
+        if use_cache:
+            remember_sql(question, schema, response, embedding)
+        return response
+
+def get_candidate_executor():
+    global _candidate_executor
+    with _candidate_executor_lock:
+        if _candidate_executor is None:
+            _candidate_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS * SQL_CANDIDATES_MAX,
+                                                     thread_name_prefix="sql-candidate")
+        return _candidate_executor
+
+def candidate_prompts(question, schema, n):
+    # Each candidate gets its own temperature and prompt hint so they actually differ
+    return [
+        (sql_prompt(question, schema, SQL_CANDIDATE_HINTS[i % len(SQL_CANDIDATE_HINTS)]),
+         {"temperature": SQL_CANDIDATE_TEMPERATURES[i % len(SQL_CANDIDATE_TEMPERATURES)]})
+        for i in range(min(n, SQL_CANDIDATES_MAX))
+    ]
+
+def distinct_candidates(responses):
+    candidates = {}
+    for response in responses:
+        if not response.startswith("Error:"):
+            candidates.setdefault(normalize_sql(clean_sql(response)), response)
+    return list(candidates.values())
+
+def explain_report(query, plan=None, error=None):
+    return {"sql": query, "cost": None if plan is None else plan[0]["Plan"]["Total Cost"], "error": error}
+
+def pick_candidate(queries, reports):
+    """The cheapest candidate that passed the guard, and whether any did."""
+    valid = [report for report in reports if report["error"] is None]
+    if not valid:
+        # Nothing passed; hand back the first so execution reports a real error
+        return queries[0], False
+    return min(valid, key=lambda report: report["cost"])["sql"], True
+
+def generate_sql_candidates(question, schema, n):
+    executor = get_candidate_executor()
+    responses = [executor.submit(generate_prompt, prompt, options=options)
+                 for prompt, options in candidate_prompts(question, schema, n)]
+    return distinct_candidates(future.result() for future in responses)
+
+def explain_sql(query, dbname, user, password, host=DB_HOST, port=DB_PORT,
+                statement_timeout=QUERY_STATEMENT_TIMEOUT_MS, max_cost=QUERY_MAX_COST):
+    try:
+        with connection(dbname, user, password, host, port) as conn, query_deadline(conn, statement_timeout):
+            with conn.cursor() as cursor:
+                plan = guard_transaction(cursor, clean_sql(query), statement_timeout, max_cost)
+    except Exception as e:
+        record_query_error(e)
+        return explain_report(query, error=str(e))
+    return explain_report(query, plan)
+
+def speculative_sql(question, dbname, user, password, host=DB_HOST, port=DB_PORT, candidates=SQL_CANDIDATES,
+                    statement_timeout=QUERY_STATEMENT_TIMEOUT_MS, max_cost=QUERY_MAX_COST, use_cache=True, index=None):
+    """Generate several candidate queries at once, EXPLAIN them in parallel and pick the cheapest valid one.
+    
+    Returns the chosen SQL and one report per distinct candidate. A cached query is
+    returned as is, with no reports; otherwise the winner goes into the SQL cache.
     """
+    schema = question_schema(question, index)
+    schema_fingerprint = fingerprint(schema)
+    embedding = None
     
-    response = generate_prompt(prompt)
-    return response
+    with span("generate_sql"):
+        if use_cache:
+            cached, embedding = cached_sql(question, schema_fingerprint)
+            if cached is not None:
+                return cached, []
+        queries = generate_sql_candidates(question, schema, candidates)
+    if not queries:
+        return "Error: no SQL candidate could be generated", []
     
-def analyze_response(question, dbname, user, password):
-    query = generate_sql(question)
+    with span("validate_sql"):
+        executor = get_candidate_executor()
+        reports = list(executor.map(
+            lambda query: explain_sql(query, dbname, user, password, host, port, statement_timeout, max_cost), queries))
+    
+    best, valid = pick_candidate(queries, reports)
+    if use_cache and valid:
+        remember_sql(question, schema, best, embedding)
+    return best, reports
+
+def sql_cache_stats():
+    return _sql_cache.stats()
+    
+def clean_sql(query):
+    # Models like to wrap SQL in code fences and end it with ";", neither of
+    # which can go inside DECLARE ... CURSOR FOR
+    query = query.strip()
+    if query.startswith("```"):
+        query = query.split("\n", 1)[1] if "\n" in query else ""
+        query = query.rsplit("```", 1)[0]
+    return query.strip().rstrip(";").strip()
+
+def result_cache_key(query, dbname, user, password, host=DB_HOST, port=DB_PORT, max_rows=RESULT_MAX_ROWS):
+    return (normalize_sql(query), *credentials_key(dbname, user, password, host, port), max_rows)
+
+def cached_result(cache_key):
+    cached = _result_cache.get(cache_key)
+    return None if cached is None else dict(cached, cached=True)
+
+def add_rows(rows, chunk, max_rows):
+    """Append a fetched chunk, keeping at most max_rows; True once the result was cut short."""
+    rows.extend(chunk)
+    if len(rows) <= max_rows:
+        return False
+    del rows[max_rows:]
+    return True
+
+def query_result(columns, types, rows, truncated, max_rows, plan, cache_key=None):
+    """The execute_query result; stored in the result cache when a cache_key is given."""
+    result = {
+        "columns": columns,
+        "types": types,
+        "rows": rows,
+        "row_count": len(rows),
+        "truncated": truncated,
+        "max_rows": max_rows,
+        "estimated_cost": plan[0]["Plan"]["Total Cost"],
+        "tables": sorted(plan_relations(plan)),
+        "cached": False,
+    }
+    if cache_key is not None:
+        _result_cache.set(cache_key, result)
+    return result
+
+def execute_query(query, dbname, user, password, host=DB_HOST, port=DB_PORT, max_rows=RESULT_MAX_ROWS,
+                  statement_timeout=QUERY_STATEMENT_TIMEOUT_MS, max_cost=QUERY_MAX_COST, use_cache=True):
+    query = clean_sql(query)
+    cache_key = result_cache_key(query, dbname, user, password, host, port, max_rows)
+    
+    if use_cache:
+        cached = cached_result(cache_key)
+        if cached is not None:
+            return cached
+    
+    rows = []
+    truncated = False
     
     try:
-        conn = psycopg2.connect(dbname=dbname, user=user, password=password, host='localhost', port=5433)
-        cursor = conn.cursor()
+        with span("execute"), connection(dbname, user, password, host, port) as conn:
+            # One deadline for EXPLAIN, DECLARE and every FETCH together
+            with query_deadline(conn, statement_timeout):
+                with conn.cursor() as cursor:
+                    plan = guard_transaction(cursor, query, statement_timeout, max_cost)
+                
+                # Named cursor keeps the result set on the server; we only pull max_rows + 1
+                with conn.cursor(name="analyze_response") as cursor:
+                    cursor.execute(query)
+                    while not truncated:
+                        chunk = cursor.fetchmany(min(RESULT_FETCH_SIZE, max_rows + 1 - len(rows)))
+                        if not chunk:
+                            break
+                        truncated = add_rows(rows, chunk, max_rows)
+                    field_name = [i[0] for i in cursor.description]
+                    field_type = [pg_type_name(i[1]) for i in cursor.description]
+                
+    except Exception as e:
+        record_query_error(e)
+        raise
+    
+    return query_result(field_name, field_type, rows, truncated, max_rows, plan, cache_key if use_cache else None)
+
+def invalidate_result_cache(table=None, dbname=None):
+    def matches(key, result):
+        return (dbname is None or key[1] == dbname) and (table is None or table in result["tables"])
+    
+    return _result_cache.invalidate_where(matches)
+
+def result_cache_stats():
+    return _result_cache.stats()
+
+def analyze_query(question, dbname, user, password, host=DB_HOST, port=DB_PORT, use_cache=True, max_rows=RESULT_MAX_ROWS,
+                  statement_timeout=QUERY_STATEMENT_TIMEOUT_MS, index=None, use_result_cache=None,
+                  candidates=SQL_CANDIDATES):
+    if candidates > 1:
+        query, reports = speculative_sql(question, dbname, user, password, host, port, candidates,
+                                         statement_timeout, use_cache=use_cache, index=index)
+    else:
+        query, reports = generate_sql(question, use_cache=use_cache, index=index), None
+    analysis = new_analysis(query, reports)
+    
+    if use_result_cache is None:
+        use_result_cache = use_cache
+    
+    try:
+        result = execute_query(query, dbname, user, password, host, port, max_rows, statement_timeout,
+                               use_cache=use_result_cache)
+        add_result(analysis, result)
         
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        conn.close()
+    except Exception as e:
+        analysis["data"] = analysis["context"] = f"Error: {e}"
+    
+    return analysis
+
+def new_analysis(query, reports=None):
+    analysis = {"sql": query, "row_count": 0, "truncated": False, "cached": False}
+    if reports is not None:
+        analysis["candidates"] = reports
+    return analysis
+
+def add_result(analysis, result):
+    analysis.update(row_count=result["row_count"], truncated=result["truncated"], cached=result["cached"])
+    analysis["result"] = result
+    analysis["data"] = build_result_markdown(result["columns"], result["rows"], result["truncated"])
+    analysis["context"] = analysis_context(result, analysis["data"])
+
+def analysis_context(result, markdown, token_budget=ANALYSIS_TOKEN_BUDGET):
+    if estimate_tokens(markdown) <= token_budget:
+        return markdown
+    summary = summarize_result(result["columns"], result["rows"], result["truncated"], token_budget, ANALYSIS_TOP_K)
+    # Only worth it if the summary is actually smaller than what it replaces
+    return summary if estimate_tokens(summary) < estimate_tokens(markdown) else markdown
+    
+def analyze_response(question, dbname, user, password, host=DB_HOST, port=DB_PORT, use_cache=True):
+    return analyze_query(question, dbname, user, password, host, port, use_cache)["data"]
+
+def warmup(dbname="flask_db", user="admin", password="secret", host=DB_HOST, port=DB_PORT):
+    # Opens the pool's minimum connections and fills the schema cache (and table
+    # embeddings, when enabled) so the first request doesn't pay for them
+    pool = get_pool(dbname, user, password, host, port)
+    index = get_schema_index(dbname, user, password, host, port)
+    if SCHEMA_EMBED_MODEL and index.table_embeddings is None:
+        documents = index.documents()
+        index.set_embeddings(dict(zip(documents, embed_batch(list(documents.values()), SCHEMA_EMBED_MODEL))))
+    return {"tables": len(index.tables), "pool": pool.stats()}
+
+def batch_error(questions):
+    """Why `questions` can't be run as a batch, or None if it can."""
+    if not isinstance(questions, list) or not all(isinstance(question, str) for question in questions):
+        return '"questions" must be a list of strings'
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        return f"At most {BATCH_MAX_QUESTIONS} questions per batch, got {len(questions)}"
+    return None
+
+def candidate_count(requested=None):
+    """Candidates for a caller-supplied value, clamped to 1..SQL_CANDIDATES_MAX; unparsable gets the default."""
+    try:
+        requested = int(requested)
+    except (TypeError, ValueError):
+        requested = SQL_CANDIDATES
+    return max(1, min(requested, SQL_CANDIDATES_MAX))
+
+def batch_entry(question, result, timings):
+    # The prompt context and the raw result set stay server-side
+    del result["context"]
+    result.pop("result", None)
+    return {"question": question, **result, "timings": timings}
+
+def get_batch_executor():
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is None:
+            _batch_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS, thread_name_prefix="analyze-batch")
+        return _batch_executor
+
+def analyze_batch(questions, dbname, user, password, host=DB_HOST, port=DB_PORT, use_cache=True,
+                  statement_timeout=QUERY_STATEMENT_TIMEOUT_MS, with_analysis=True, candidates=SQL_CANDIDATES):
+    # One schema load for the whole batch instead of one per question
+    try:
+        index = default_schema_index()
+    except Exception:
+        index = None
+    
+    def run(question):
+        start = time.perf_counter()
+        result = analyze_query(question, dbname, user, password, host, port, use_cache,
+                               statement_timeout=statement_timeout, index=index, candidates=candidates)
+        timings = {"query": time.perf_counter() - start}
         
-        field_name = [i[0] for i in cursor.description]
-        table = "| " + " | ".join(field_name) + " |\n"
-        table += "| " + " | ".join(["-" * len(name) for name in field_name]) + " |\n"
+        if with_analysis:
+            analysis_start = time.perf_counter()
+            result["analysis"] = response_analysis(question, result["context"])
+            timings["analysis"] = time.perf_counter() - analysis_start
         
-        for row in rows:
-            table += "| " + " | ".join(map(str, row)) + " |\n"
-            
-        return table
+        timings["total"] = time.perf_counter() - start
+        return batch_entry(question, result, timings)
+    
+    # Worker threads don't inherit contextvars; give each question a copy of this
+    # request's context so its spans land in the request trace
+    contexts = [contextvars.copy_context() for _ in questions]
+    return list(get_batch_executor().map(lambda context, question: context.run(run, question), contexts, questions))
+
+def build_result_markdown(field_name, rows, truncated=False):
+    lines = [
+        "| " + " | ".join(field_name) + " |",
+        "| " + " | ".join(["-" * len(name) for name in field_name]) + " |",
+    ]
+    lines.extend("| " + " | ".join(map(str, row)) + " |" for row in rows)
+    
+    if truncated:
+        lines.append("")
+        lines.append(f"_Showing the first {len(rows)} rows; the result was truncated._")
         
-    except Exception as e:
-        return f"Error: {e}"
+    return "\n".join(lines) + "\n"
     
     
-def response_analysis(question, response):
-    query = f"""
+def analysis_prompt(question, response):
+    return f"""
         Act as Senio Data Analyst, provide your analysis from following question: 
         
         {question}
@@ -104,7 +628,13 @@ def response_analysis(question, response):
         {response}    
     """
     
-    return generate_prompt(query)
+def response_analysis(question, response):
+    with span("response_analysis"):
+        return generate_prompt(analysis_prompt(question, response))
+
+def stream_analysis(question, response):
+    with span("response_analysis"):
+        yield from stream_prompt(analysis_prompt(question, response))
     
 if __name__ == "__main__":
  
@@ -114,5 +644,5 @@ if __name__ == "__main__":
     # print(schema_markdown)
 
     # print(generate_prompt("Explain the theory of relativity in simple terms."))
-    result = analyze_response(question, dbname, user, password)
-    print(response_analysis(question, result))
\ No newline at end of file
+    result = analyze_query(question, dbname, user, password)
+    print(response_analysis(question, result["context"]))
\ No newline at end of file
@@ -0,0 +1,143 @@
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; wide enough for both sub-millisecond cache hits and minute-long LLM calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram with bucket-interpolated quantiles."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def _quantile(self, q, counts, total):
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                if index == len(self.buckets):
+                    return lower
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def quantile(self, q):
+        counts, total, _ = self._state()
+        return self._quantile(q, counts, total)
+
+    def _state(self):
+        with self._lock:
+            return list(self._counts), self._count, self._sum
+
+    def snapshot(self):
+        counts, total, total_sum = self._state()
+        return {
+            "count": total,
+            "sum": total_sum,
+            "p50": self._quantile(0.50, counts, total),
+            "p95": self._quantile(0.95, counts, total),
+            "p99": self._quantile(0.99, counts, total),
+            "buckets": dict(zip([*map(str, self.buckets), "+Inf"], counts)),
+        }
+
+
+# Always send the per-stage Server-Timing header, not only when ?trace=1 is passed
+TRACE_HEADER = os.getenv("TRACE_HEADER", "false").lower() in ("1", "true", "yes")
+
+STAGES = ("schema", "generate_sql", "validate_sql", "execute", "response_analysis")
+
+stage_latency = {stage: Histogram() for stage in STAGES}
+
+# stage -> seconds for the request currently being handled, if tracing is on
+_trace = contextvars.ContextVar("trace", default=None)
+# Batch workers share their request's trace dict
+_trace_lock = threading.Lock()
+
+
+def start_trace():
+    trace = {}
+    _trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _trace.get()
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_latency[stage].observe(elapsed)
+        trace = _trace.get()
+        if trace is not None:
+            with _trace_lock:
+                trace[stage] = trace.get(stage, 0.0) + elapsed
+
+
+def server_timing(trace):
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in trace.items())
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def render_histograms(name, help_text, histograms, label):
+    """Prometheus text exposition for a family of histograms keyed by one label value."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    quantiles = []
+    for value, histogram in histograms.items():
+        counts, total, total_sum = histogram._state()
+        cumulative = 0
+        for bound, count in zip([*histogram.buckets, "+Inf"], counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels({label: value, 'le': bound})} {cumulative}")
+        lines.append(f"{name}_sum{_labels({label: value})} {total_sum}")
+        lines.append(f"{name}_count{_labels({label: value})} {total}")
+        for q in (0.5, 0.95, 0.99):
+            quantiles.append(f"{name}_quantile{_labels({label: value, 'quantile': q})} {histogram._quantile(q, counts, total)}")
+
+    lines += [f"# HELP {name}_quantile p50/p95/p99 of {name}, interpolated from buckets",
+              f"# TYPE {name}_quantile gauge"] + quantiles
+    return "\n".join(lines) + "\n"
+
+
+def render_gauges(name, help_text, samples, kind="gauge"):
+    """samples is a list of (labels dict, value) pairs."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    lines += [f"{name}{_labels(labels)} {float(value)}" for labels, value in samples]
+    return "\n".join(lines) + "\n"
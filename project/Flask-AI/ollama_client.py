@@ -0,0 +1,67 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import Histogram
+
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", 5))
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", 300))
+OLLAMA_RETRIES = int(os.getenv("OLLAMA_RETRIES", 3))
+OLLAMA_BACKOFF = float(os.getenv("OLLAMA_BACKOFF", 0.5))
+OLLAMA_POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", 16))
+
+_session = None
+_session_lock = threading.Lock()
+
+latency = {
+    "generate": Histogram(),
+    "stream_first_token": Histogram(),
+    "stream_total": Histogram(),
+}
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                # Ollama's /api/generate is safe to replay, so POST is retried too
+                retry = Retry(
+                    total=OLLAMA_RETRIES,
+                    backoff_factor=OLLAMA_BACKOFF,
+                    status_forcelist=(500, 502, 503, 504),
+                    allowed_methods=frozenset({"GET", "POST"}),
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=OLLAMA_POOL_SIZE,
+                    pool_maxsize=OLLAMA_POOL_SIZE,
+                    max_retries=retry,
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def post(url, **kwargs):
+    kwargs.setdefault("timeout", (OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT))
+    return get_session().post(url, **kwargs)
+
+
+def latency_stats():
+    return {name: histogram.snapshot() for name, histogram in latency.items()}
+
+
+def close_session():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
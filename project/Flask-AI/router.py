@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from ollama_client import OLLAMA_HOST
+
+# Comma-separated Ollama base URLs; defaults to the single OLLAMA_HOST
+OLLAMA_BACKENDS = [host.strip() for host in os.getenv("OLLAMA_BACKENDS", OLLAMA_HOST).split(",") if host.strip()]
+OLLAMA_BACKEND_CONCURRENCY = int(os.getenv("OLLAMA_BACKEND_CONCURRENCY", 4))
+OLLAMA_MAX_QUEUE = int(os.getenv("OLLAMA_MAX_QUEUE", 64))
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv("OLLAMA_QUEUE_TIMEOUT", 60))
+OLLAMA_EJECT_AFTER = int(os.getenv("OLLAMA_EJECT_AFTER", 3))
+OLLAMA_EJECT_SECONDS = float(os.getenv("OLLAMA_EJECT_SECONDS", 30))
+
+
+class Overloaded(Exception):
+    pass
+
+
+def is_backend_failure(error):
+    # Connection errors and 5xx count against the host; a 4xx is the caller's fault
+    response = getattr(error, "response", None)
+    return response is None or response.status_code >= 500
+
+
+class Backend:
+    def __init__(self, host, max_concurrency):
+        self.host = host.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    def ejected(self, now):
+        return self.ejected_until > now
+
+    def stats(self, now):
+        return {
+            "outstanding": self.outstanding,
+            "max_concurrency": self.max_concurrency,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejected": self.ejected(now),
+        }
+
+
+class Router:
+    """Least-outstanding-requests balancer over Ollama hosts with a bounded wait queue."""
+
+    def __init__(self, hosts, max_concurrency=OLLAMA_BACKEND_CONCURRENCY, max_queue=OLLAMA_MAX_QUEUE,
+                 queue_timeout=OLLAMA_QUEUE_TIMEOUT, eject_after=OLLAMA_EJECT_AFTER, eject_seconds=OLLAMA_EJECT_SECONDS):
+        self.backends = [Backend(host, max_concurrency) for host in hosts]
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+
+        self._cond = threading.Condition()
+        self._waiting = 0
+        self._rejected = 0
+        self._queue_timeouts = 0
+
+    def _pick(self):
+        now = time.monotonic()
+        healthy = [backend for backend in self.backends if not backend.ejected(now)]
+        # If every host is ejected, keep serving from all of them rather than fail outright
+        candidates = [backend for backend in healthy or self.backends
+                      if backend.outstanding < backend.max_concurrency]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda backend: backend.outstanding / backend.max_concurrency)
+
+    def _release(self, backend, failed):
+        with self._cond:
+            backend.outstanding -= 1
+            if failed:
+                backend.failures += 1
+                backend.consecutive_failures += 1
+                if backend.consecutive_failures >= self.eject_after:
+                    backend.ejected_until = time.monotonic() + self.eject_seconds
+                    backend.consecutive_failures = 0
+            else:
+                backend.consecutive_failures = 0
+            self._cond.notify()
+
+    @contextmanager
+    def acquire(self):
+        deadline = time.monotonic() + self.queue_timeout
+
+        with self._cond:
+            backend = self._pick()
+            if backend is None:
+                if self._waiting >= self.max_queue:
+                    self._rejected += 1
+                    raise Overloaded(f"All Ollama backends busy and {self._waiting} requests already queued")
+
+                self._waiting += 1
+                try:
+                    while backend is None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._queue_timeouts += 1
+                            raise Overloaded(f"No Ollama backend free after {self.queue_timeout}s")
+                        # Wake up at least when an ejection may have expired
+                        self._cond.wait(min(remaining, self.eject_seconds))
+                        backend = self._pick()
+                finally:
+                    self._waiting -= 1
+
+            backend.outstanding += 1
+            backend.requests += 1
+
+        failed = False
+        try:
+            yield backend.host
+        except Exception as e:
+            failed = is_backend_failure(e)
+            raise
+        finally:
+            self._release(backend, failed)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._cond:
+            return {
+                "queued": self._waiting,
+                "max_queue": self.max_queue,
+                "rejected": self._rejected,
+                "queue_timeouts": self._queue_timeouts,
+                "backends": {backend.host: backend.stats(now) for backend in self.backends},
+            }
+
+
+router = Router(OLLAMA_BACKENDS)
@@ -0,0 +1,128 @@
+import math
+import re
+from collections import Counter
+
+import numpy as np
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        # Crude plural folding so "customers" matches a "customer" table
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class SchemaIndex:
+    """Per-table keyword (and optional embedding) index over schema rows.
+
+    Rows are (table_name, column_name, data_type[, table_comment, column_comment[, referenced_table]]).
+    """
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.tables = {}
+        for row in self.rows:
+            self.tables.setdefault(row[0], []).append(row)
+
+        self._name_tokens = {}
+        self._tokens = {}
+        for table, columns in self.tables.items():
+            text = [table] + [column[1] for column in columns]
+            text += [comment for column in columns for comment in column[3:5] if comment]
+            self._name_tokens[table] = set(tokenize(table))
+            self._tokens[table] = set(tokenize(" ".join(text)))
+
+        document_frequency = Counter(token for tokens in self._tokens.values() for token in tokens)
+        total = len(self.tables)
+        self._idf = {token: math.log(1 + total / count) for token, count in document_frequency.items()}
+
+        # Tables joined by a foreign key, or by the "<table>_id" naming convention
+        # when the schema declares none
+        names = {" ".join(tokenize(table)): table for table in self.tables}
+        self.links = {table: set() for table in self.tables}
+        for row in self.rows:
+            target = row[5] if len(row) > 5 and row[5] else None
+            if target is None and row[1].lower().endswith("_id"):
+                target = names.get(" ".join(tokenize(row[1][:-3])))
+            if target in self.links and target != row[0]:
+                self.links[row[0]].add(target)
+                self.links[target].add(row[0])
+
+        self.table_embeddings = None
+
+    def __len__(self):
+        return len(self.tables)
+
+    def documents(self):
+        documents = {}
+        for table, columns in self.tables.items():
+            comment = next((column[3] for column in columns if len(column) > 3 and column[3]), "")
+            fields = ", ".join(column[1] for column in columns)
+            documents[table] = f"{table}: {comment} ({fields})" if comment else f"{table} ({fields})"
+        return documents
+
+    def set_embeddings(self, embeddings):
+        names = list(self.tables)
+        matrix = np.asarray([embeddings[name] for name in names], dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.table_embeddings = (names, matrix / np.where(norms == 0, 1, norms))
+
+    def keyword_scores(self, question):
+        scores = {}
+        for token in set(tokenize(question)):
+            idf = self._idf.get(token)
+            if idf is None:
+                continue
+            for table, tokens in self._tokens.items():
+                if token in tokens:
+                    # A hit on the table name itself counts double
+                    weight = 2 if token in self._name_tokens[table] else 1
+                    scores[table] = scores.get(table, 0.0) + weight * idf
+        return scores
+
+    def select(self, question, top_n, question_embedding=None):
+        if top_n <= 0 or len(self.tables) <= top_n:
+            return list(self.tables)
+
+        scores = self.keyword_scores(question)
+        if scores:
+            best = max(scores.values())
+            scores = {table: score / best for table, score in scores.items()}
+
+        if question_embedding is not None and self.table_embeddings is not None:
+            names, matrix = self.table_embeddings
+            query = np.asarray(question_embedding, dtype=np.float32)
+            query /= np.linalg.norm(query) or 1
+            for name, similarity in zip(names, matrix @ query):
+                scores[name] = scores.get(name, 0.0) + float(similarity)
+
+        if not scores:
+            # Nothing to go on; better a big prompt than a wrong one
+            return list(self.tables)
+
+        ranked = sorted(scores, key=scores.get, reverse=True)[:top_n]
+        selected = set(ranked)
+        # Fill spare slots with the tables the matches join through (order_items for
+        # "revenue per customer"), nearest first; the question rarely names them
+        frontier = ranked
+        while frontier and len(selected) < top_n:
+            neighbours = sorted({table for name in frontier for table in self.links[name]} - selected,
+                                key=lambda table: -scores.get(table, 0.0))
+            frontier = neighbours[:top_n - len(selected)]
+            selected.update(frontier)
+        return [table for table in self.tables if table in selected]
+
+    def markdown(self, tables=None):
+        if not self.rows:
+            return "No tables found in the database."
+
+        tables = self.tables if tables is None else tables
+        lines = ["|Table name | Column name | Data type |", "| --------- | ----------- | ---------- | "]
+        for table in tables:
+            lines.extend(f"|{row[0]} | {row[1]} | {row[2]} |" for row in self.tables[table])
+        return "\n".join(lines) + "\n"
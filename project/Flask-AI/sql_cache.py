@@ -0,0 +1,97 @@
+import hashlib
+import re
+import threading
+
+import numpy as np
+
+from cache import TTLCache
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+# Quoted literals and identifiers are case- and space-sensitive, so leave them alone
+_SQL_QUOTED = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+
+
+def normalize_question(question):
+    question = _PUNCTUATION.sub(" ", question.lower())
+    return _WHITESPACE.sub(" ", question).strip()
+
+
+def normalize_sql(query):
+    parts = _SQL_QUOTED.split(query.strip().rstrip(";"))
+    for i in range(0, len(parts), 2):
+        parts[i] = _WHITESPACE.sub(" ", parts[i].lower())
+    return "".join(parts).strip()
+
+
+def fingerprint(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class SQLCache:
+    """Generated SQL keyed by (normalized question, schema fingerprint).
+
+    Exact lookups go through `get`. When an embedding is available, `get_similar`
+    finds the closest cached question for the same schema above `similarity`.
+    """
+
+    def __init__(self, maxsize=512, ttl=None, similarity=0.92):
+        self.similarity = similarity
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._semantic_hits = 0
+        self._misses = 0
+
+    def get(self, question, schema_fingerprint):
+        entry = self._entries.get((normalize_question(question), schema_fingerprint))
+        with self._lock:
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+        return entry[0]
+
+    def get_similar(self, schema_fingerprint, embedding):
+        candidates = [
+            (key, value) for key, value in self._entries.items()
+            if key[1] == schema_fingerprint and value[1] is not None
+        ]
+        if not candidates:
+            return None
+
+        query = np.asarray(embedding, dtype=np.float32)
+        matrix = np.asarray([value[1] for _, value in candidates], dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+        scores = matrix @ query / np.where(norms == 0, 1, norms)
+
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity:
+            return None
+
+        key, (sql, _) = candidates[best]
+        self._entries.get(key)  # refresh LRU position
+        with self._lock:
+            # The exact lookup that preceded this already counted a miss
+            self._misses -= 1
+            self._semantic_hits += 1
+        return sql
+
+    def set(self, question, schema_fingerprint, sql, embedding=None):
+        self._entries.set((normalize_question(question), schema_fingerprint), (sql, embedding))
+
+    def clear(self):
+        return self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            hits, semantic_hits, misses = self._hits, self._semantic_hits, self._misses
+        lookups = hits + semantic_hits + misses
+        return {
+            "size": len(self._entries),
+            "max_size": self._entries.maxsize,
+            "hits": hits,
+            "semantic_hits": semantic_hits,
+            "misses": misses,
+            "hit_rate": (hits + semantic_hits) / lookups if lookups else 0.0,
+        }
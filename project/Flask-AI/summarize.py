@@ -0,0 +1,143 @@
+import datetime
+
+import pandas as pd
+
+
+def estimate_tokens(text):
+    # ~4 characters per token is close enough for English and SQL-ish text
+    return len(text) // 4 + 1
+
+
+def _unique_columns(columns):
+    seen = {}
+    unique = []
+    for name in columns:
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        unique.append(name if count == 0 else f"{name}_{count}")
+    return unique
+
+
+def _format(value):
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    return str(value)
+
+
+def _all_instances(values, kind):
+    values = values.dropna()
+    return not values.empty and all(isinstance(value, kind) for value in values)
+
+
+def column_statistics(columns, rows, top_k=5):
+    frame = pd.DataFrame.from_records(rows, columns=_unique_columns(columns))
+    dates = set()
+
+    for name in frame.columns[frame.dtypes == object]:
+        # Bools with NULLs land here too; pd.to_numeric would make them floats with a mean
+        if _all_instances(frame[name], bool):
+            frame[name] = frame[name].astype("boolean")
+            continue
+        # date (and datetime with an offset) stays object and would otherwise get only top values
+        if _all_instances(frame[name], datetime.date):
+            values = frame[name].dropna()
+            try:
+                frame[name] = pd.to_datetime(frame[name], utc=any(
+                    getattr(value, "tzinfo", None) is not None for value in values))
+                if not any(isinstance(value, datetime.datetime) for value in values):
+                    dates.add(name)
+                continue
+            except (ValueError, TypeError, OverflowError):
+                pass
+        # Postgres numeric comes back as Decimal (object dtype); coerce where it fits
+        try:
+            frame[name] = pd.to_numeric(frame[name])
+        except (ValueError, TypeError):
+            # Stringify the rest so json/array values don't break hashing below
+            frame[name] = frame[name].where(frame[name].isna(), frame[name].astype(str))
+
+    non_null = frame.count()
+    distinct = frame.nunique(dropna=True)
+    numeric = frame.select_dtypes(include=["number", "datetime", "datetimetz"])
+    bounds = numeric.agg(["min", "max"]) if not numeric.empty else pd.DataFrame()
+    means = frame.select_dtypes(include="number").mean()
+
+    stats = []
+    for name in frame.columns:
+        column = {
+            "column": name,
+            "type": str(frame[name].dtype),
+            "non_null": int(non_null[name]),
+            "distinct": int(distinct[name]),
+        }
+        if not column["non_null"]:
+            pass
+        elif name in bounds.columns:
+            low, high = bounds.at["min", name], bounds.at["max", name]
+            if name in dates:
+                # The midnight time pandas adds to a date says nothing
+                low, high = low.date(), high.date()
+            column["min"] = _format(low)
+            column["max"] = _format(high)
+            if name in means.index:
+                column["mean"] = _format(means[name])
+        elif column["distinct"] < column["non_null"]:
+            # Top values only say something when some values repeat
+            top = frame[name].value_counts(dropna=True).head(top_k)
+            column["top"] = [f"{_format(value)} ({count})" for value, count in top.items()]
+        stats.append(column)
+
+    return stats
+
+
+def summarize_result(columns, rows, truncated=False, token_budget=2000, top_k=5):
+    header = f"Result: {len(rows)} rows x {len(columns)} columns"
+    if truncated:
+        header += " (truncated; statistics cover the fetched rows only)"
+
+    lines = [header, "", "| Column | Type | Non-null | Distinct | Min | Max | Mean | Top values |",
+             "| ------ | ---- | -------- | -------- | --- | --- | ---- | ---------- |"]
+    remaining = token_budget - estimate_tokens("\n".join(lines))
+    stats = column_statistics(columns, rows, top_k)
+    for shown, column in enumerate(stats):
+        line = "| " + " | ".join([
+            column["column"],
+            column["type"],
+            str(column["non_null"]),
+            str(column["distinct"]),
+            column.get("min", ""),
+            column.get("max", ""),
+            column.get("mean", ""),
+            ", ".join(column.get("top", [])),
+        ]) + " |"
+        # Wide results: stop before the table alone blows the budget, leaving room for the note
+        cost = estimate_tokens(line)
+        if cost > remaining - 10:
+            lines.append(f"\n_({len(stats) - shown} more columns not shown)_")
+            break
+        lines.append(line)
+        remaining -= cost
+
+    summary = "\n".join(lines) + "\n"
+
+    # Spend whatever budget is left on a sample of leading rows
+    remaining = token_budget - estimate_tokens(summary)
+    sample = [
+        "| " + " | ".join(columns) + " |",
+        "| " + " | ".join(["-" * len(name) for name in columns]) + " |",
+    ]
+    remaining -= estimate_tokens("\n".join(sample))
+    sampled = 0
+    for row in rows:
+        line = "| " + " | ".join(map(str, row)) + " |"
+        cost = estimate_tokens(line)
+        if cost > remaining:
+            break
+        sample.append(line)
+        remaining -= cost
+        sampled += 1
+
+    if sampled:
+        summary += f"\nSample of {sampled} rows:\n\n" + "\n".join(sample) + "\n"
+
+    return summary
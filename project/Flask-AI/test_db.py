@@ -0,0 +1,106 @@
+import asyncio
+import os
+import re
+import time
+
+import psycopg2
+import pytest
+
+import db
+from db import DB_HOST, DB_PORT, QueryRejected, QueryTimeout, has_multiple_statements, vet_query
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT 1; COMMIT; DELETE FROM customers",
+    "SELECT 1;",
+    "SELECT 1 -- '\n; DELETE FROM customers --'",
+    "SELECT 1 /* ' */ ; DELETE FROM customers",
+    "SELECT 'unterminated; DELETE FROM customers",
+])
+def test_rejects_stacked_statements(query):
+    assert has_multiple_statements(query)
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT name FROM customers",
+    "SELECT ';' AS semicolon",
+    "SELECT 'it''s; fine'",
+    'SELECT "odd;column" FROM customers',
+    "SELECT $$a;b$$, $tag$c;d$tag$",
+    "SELECT E'\\'; still a literal'",
+    "SELECT 1 /* nested /* ; */ comment */",
+])
+def test_allows_single_statement(query):
+    assert not has_multiple_statements(query)
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT set_config('statement_timeout', '0', true)",
+    "SELECT PG_CATALOG.SET_CONFIG('statement_timeout', '0', true)",
+    'SELECT "set_config"(\'work_mem\', \'1GB\', true)',
+])
+def test_rejects_set_config(query):
+    with pytest.raises(QueryRejected):
+        vet_query(query)
+
+
+# Lifts statement_timeout on the first row, then sleeps 2s on each of the others
+BYPASS_QUERY = ("SELECT CASE WHEN i = 1 THEN set_config('statement_timeout', '0', true) "
+                "ELSE pg_sleep(2)::text END FROM generate_series(1, 3) i")
+# Each FETCH of RESULT_FETCH_SIZE rows stays under the limit; all of them together don't
+SLOW_FETCH_QUERY = "SELECT pg_sleep(0.0015), i FROM generate_series(1, 2000) i"
+
+TEST_DB = (
+    os.getenv("TEST_DB_NAME", "flask_db"),
+    os.getenv("TEST_DB_USER", "admin"),
+    os.getenv("TEST_DB_PASSWORD", "secret"),
+    os.getenv("TEST_DB_HOST", DB_HOST),
+    int(os.getenv("TEST_DB_PORT", DB_PORT)),
+)
+
+
+@pytest.fixture(scope="module")
+def database():
+    dbname, user, password, host, port = TEST_DB
+    try:
+        psycopg2.connect(dbname=dbname, user=user, password=password, host=host, port=port).close()
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"no test database: {e}")
+    return TEST_DB
+
+
+@pytest.fixture
+def without_set_config_check(monkeypatch):
+    # The deadline has to hold even for SQL that slips past vet_query
+    monkeypatch.setattr(db, "_FORBIDDEN_FUNCTIONS", re.compile(r"(?!)"))
+
+
+@pytest.mark.parametrize("query", [BYPASS_QUERY, SLOW_FETCH_QUERY])
+def test_deadline_covers_the_whole_query(database, without_set_config_check, query):
+    llm = pytest.importorskip("llm")
+    start = time.monotonic()
+    with pytest.raises(QueryTimeout):
+        llm.execute_query(query, *database, max_rows=1000, statement_timeout=1000, use_cache=False)
+    assert time.monotonic() - start < 1.5
+    # The pool is still usable after a cancelled query
+    assert llm.execute_query("SELECT 1", *database, use_cache=False)["rows"] == [(1,)]
+
+
+@pytest.mark.parametrize("query", [BYPASS_QUERY, SLOW_FETCH_QUERY])
+def test_async_deadline_covers_the_whole_query(database, without_set_config_check, query):
+    pytest.importorskip("asyncpg")
+    async_llm = pytest.importorskip("async_llm")
+
+    async def run():
+        try:
+            start = time.monotonic()
+            with pytest.raises(QueryTimeout):
+                await async_llm.execute_query(query, *database, max_rows=1000, statement_timeout=1000,
+                                              use_cache=False)
+            assert time.monotonic() - start < 1.5
+            result = await async_llm.execute_query("SELECT 1 AS one", *database, use_cache=False)
+            assert [tuple(row) for row in result["rows"]] == [(1,)]
+        finally:
+            await async_llm.close()
+
+    asyncio.run(run())
@@ -1,12 +1,254 @@
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import streamlit as st
 from langchain_openai import ChatOpenAI
 from langchain.schema import HumanMessage, SystemMessage, AIMessage
-from langchain.memory import ConversationBufferWindowMemory
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Response cache shared by every session in this process
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 256))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 3600))
+# Tokens of past conversation sent with each turn; older turns are dropped or summarized
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 2000))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+
+# Focus areas offered in the sidebar; prompts always list them in this order
+EXPERTISE_AREAS = (
+    "Stock Analysis",
+    "Crypto & Blockchain",
+    "Portfolio Management",
+    "Risk Assessment",
+    "Technical Analysis",
+    "Fundamental Analysis",
+    "Market Trends",
+    "Investment Strategies",
+)
+
+# Conversations persist here across restarts
+CHAT_DB_PATH = os.getenv("CHAT_DB_PATH", "chat_history.db")
+# The store is shared by everyone using this server. By default each browser session
+# only lists the conversations it opened itself; set this to list all of them, e.g.
+# for a single-user local install.
+CHAT_SHARED_HISTORY = os.getenv("CHAT_SHARED_HISTORY", "false").lower() in ("1", "true", "yes")
+# Messages rendered per page in the chat container
+CHAT_PAGE_SIZE = int(os.getenv("CHAT_PAGE_SIZE", 30))
+# Most recent messages kept in memory for windowing; older ones are only read back for display
+HISTORY_LOAD_LIMIT = int(os.getenv("HISTORY_LOAD_LIMIT", 200))
+
+_encoding = tiktoken.get_encoding("o200k_base") if tiktoken else None
+
+
+def count_tokens(text):
+    if _encoding is None:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+class ChatStore:
+    """SQLite store for conversations, shared by all sessions through one locked connection."""
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            title TEXT,
+            summary TEXT NOT NULL DEFAULT '',
+            summarized_id INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id TEXT NOT NULL REFERENCES conversations(id) ON DELETE CASCADE,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            tokens INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages (conversation_id, id);
+    """
+    
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+    
+    def conversations(self, ids=None, limit=20):
+        """Most recently updated conversations, restricted to `ids` unless it is None."""
+        query, params = "SELECT id, title FROM conversations", []
+        if ids is not None:
+            if not ids:
+                return []
+            query += f" WHERE id IN ({', '.join('?' * len(ids))})"
+            params.extend(ids)
+        with self._lock:
+            return self._conn.execute(query + " ORDER BY updated_at DESC LIMIT ?", (*params, limit)).fetchall()
+    
+    def add_message(self, conversation_id, role, content, tokens):
+        now = time.time()
+        with self._lock, self._conn:
+            # The conversation row is created by its first message, so unused sessions leave nothing behind
+            self._conn.execute(
+                "INSERT INTO conversations (id, title, created_at, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET updated_at = excluded.updated_at",
+                (conversation_id, content[:60], now, now)
+            )
+            cursor = self._conn.execute(
+                "INSERT INTO messages (conversation_id, role, content, tokens, created_at) VALUES (?, ?, ?, ?, ?)",
+                (conversation_id, role, content, tokens, now)
+            )
+            return cursor.lastrowid
+    
+    def messages(self, conversation_id, limit):
+        """The newest `limit` messages, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, role, content, tokens FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+                (conversation_id, limit)
+            ).fetchall()
+        return [{"id": id, "role": role, "content": content, "tokens": tokens} for id, role, content, tokens in reversed(rows)]
+    
+    def count(self, conversation_id):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM messages WHERE conversation_id = ?", (conversation_id,)).fetchone()[0]
+    
+    def summary(self, conversation_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary, summarized_id FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+        return row or ("", 0)
+    
+    def save_summary(self, conversation_id, summary, summarized_id):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE conversations SET summary = ?, summarized_id = ? WHERE id = ?",
+                (summary, summarized_id, conversation_id)
+            )
+    
+    def delete(self, conversation_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+
+@st.cache_resource
+def get_chat_store():
+    return ChatStore(CHAT_DB_PATH)
+
+
+class ConversationHistory:
+    """Chat turns with their token counts, counted once when each turn is added.
+    
+    Holds the newest HISTORY_LOAD_LIMIT turns of a stored conversation; every turn
+    added is written through to the store. Turns before `summarized` have been
+    folded into `summary`.
+    """
+    
+    def __init__(self, store, conversation_id):
+        self.store = store
+        self.conversation_id = conversation_id
+        self.messages = store.messages(conversation_id, HISTORY_LOAD_LIMIT)
+        self.summary, summarized_id = store.summary(conversation_id)
+        self.summary_tokens = count_tokens(self.summary) if self.summary else 0
+        self.summarized = sum(1 for msg in self.messages if msg["id"] <= summarized_id)
+    
+    def add(self, role, content):
+        tokens = count_tokens(content)
+        message_id = self.store.add_message(self.conversation_id, role, content, tokens)
+        self.messages.append({"id": message_id, "role": role, "content": content, "tokens": tokens})
+        
+        if len(self.messages) > HISTORY_LOAD_LIMIT:
+            dropped = len(self.messages) - HISTORY_LOAD_LIMIT
+            del self.messages[:dropped]
+            self.summarized = max(0, self.summarized - dropped)
+    
+    def __len__(self):
+        return self.store.count(self.conversation_id)
+    
+    def window_start(self, budget, end=None):
+        end = len(self.messages) if end is None else end
+        budget -= self.summary_tokens
+        start = end
+        while start > self.summarized and self.messages[start - 1]["tokens"] <= budget:
+            start -= 1
+            budget -= self.messages[start]["tokens"]
+        return start
+    
+    def window(self, budget, end=None):
+        """Most recent (role, content) turns before `end` that fit in `budget` tokens."""
+        end = len(self.messages) if end is None else end
+        return [(msg["role"], msg["content"]) for msg in self.messages[self.window_start(budget, end):end]]
+    
+    def roll_summary(self, budget, summarize):
+        # Fold the turns that no longer fit into the running summary
+        start = self.window_start(budget)
+        if start <= self.summarized:
+            return
+        dropped = [(msg["role"], msg["content"]) for msg in self.messages[self.summarized:start]]
+        self.summary = summarize(self.summary, dropped)
+        self.summary_tokens = count_tokens(self.summary)
+        self.summarized = start
+        self.store.save_summary(self.conversation_id, self.summary, self.messages[start - 1]["id"])
+
+
+class ResponseCache:
+    """Bounded LRU of finished answers; entries expire after `ttl` seconds."""
+    
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def key(system_prompt, history, message, model_name, temperature):
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (system_prompt, model_name, f"{temperature:.2f}", message):
+            digest.update(part.encode("utf-8") + b"\0")
+        for role, content in history:
+            digest.update(role.encode("utf-8") + b"\0" + content.encode("utf-8") + b"\0")
+        return digest.hexdigest()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self._entries.pop(key, None)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+    
+    def set(self, key, response):
+        with self._lock:
+            self._entries[key] = (response, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+    
+    def __len__(self):
+        return len(self._entries)
+
+
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
 # Page configuration
 st.set_page_config(
     page_title="💰 Finance AI Expert",
@@ -49,15 +291,25 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+def open_conversation(conversation_id):
+    # Conversations this session may list and switch between
+    owned = st.session_state.setdefault("conversation_ids", [])
+    if conversation_id not in owned:
+        owned.append(conversation_id)
+    st.session_state.history = ConversationHistory(get_chat_store(), conversation_id)
+    st.session_state.visible_messages = CHAT_PAGE_SIZE
+    # Keeps the conversation across browser reloads and server restarts
+    st.query_params["conversation"] = conversation_id
+
 # Initialize session state
-if "messages" not in st.session_state:
-    st.session_state.messages = [] # Store chat history
+if "history" not in st.session_state:
+    open_conversation(st.query_params.get("conversation") or uuid.uuid4().hex) # Store chat history
 
-if "memory" not in st.session_state:
-    st.session_state.memory = ConversationBufferWindowMemory(
-        k=10,  # Remember last 10 exchanges
-        return_messages=True
-    )
+if "race_results" not in st.session_state:
+    st.session_state.race_results = []
+
+if "cache_stats" not in st.session_state:
+    st.session_state.cache_stats = {"hits": 0, "misses": 0}
 
 # Main header
 st.markdown("""
@@ -86,6 +338,16 @@ with st.sidebar:
     )
     model_name = model_options[selected_model]
     
+    # Race mode: the fast model answers first, the strong one replaces it when it arrives
+    race_mode = st.toggle(
+        "🏁 Race mode",
+        value=False,
+        help="Send each question to a fast and a strong model at once and compare them"
+    )
+    if race_mode:
+        fast_model = model_options[st.selectbox("Fast model", options=list(model_options.keys()), index=0)]
+        model_name = model_options[st.selectbox("Strong model", options=list(model_options.keys()), index=1)]
+    
     # Temperature setting
     temperature = st.slider(
         "Response Creativity",
@@ -100,23 +362,42 @@ with st.sidebar:
     st.subheader("🎯Model Expertise")
     expertise_areas = st.multiselect(
         "Select areas of focus:",
-        [
-            "Stock Analysis", 
-            "Crypto & Blockchain", 
-            "Portfolio Management",
-            "Risk Assessment",
-            "Technical Analysis",
-            "Fundamental Analysis",
-            "Market Trends",
-            "Investment Strategies"
-        ],
+        list(EXPERTISE_AREAS),
         default=["Stock Analysis", "Crypto & Blockchain", "Portfolio Management"]
     )
     
+    # Long conversations: summarize turns that fall out of the token window instead of dropping them
+    summarize_history = st.checkbox(
+        "Summarize older messages",
+        value=False,
+        help=f"Keeps a running summary of turns beyond the last {HISTORY_TOKEN_BUDGET} tokens of history"
+    )
+    
+    # Saved conversations
+    st.subheader("💬 Conversations")
+    if st.button("➕ New Chat"):
+        open_conversation(uuid.uuid4().hex)
+        st.rerun()
+    
+    saved = get_chat_store().conversations(None if CHAT_SHARED_HISTORY else st.session_state.conversation_ids)
+    current_id = st.session_state.history.conversation_id
+    titles = {conversation_id: title for conversation_id, title in saved}
+    if titles:
+        options = list(titles) if current_id in titles else [current_id] + list(titles)
+        chosen = st.selectbox(
+            "Open conversation",
+            options=options,
+            index=options.index(current_id),
+            format_func=lambda conversation_id: titles.get(conversation_id, "New chat")
+        )
+        if chosen != current_id:
+            open_conversation(chosen)
+            st.rerun()
+    
     # Clear history action
     if st.button("🗑️ Clear Chat History"):
-        st.session_state.messages = []
-        st.session_state.memory.clear()
+        get_chat_store().delete(st.session_state.history.conversation_id)
+        open_conversation(uuid.uuid4().hex)
         st.success("Chat history cleared!")
         st.rerun()
     
@@ -125,18 +406,45 @@ with st.sidebar:
     # Stats
     st.markdown("---")
     st.subheader("📈 Session Stats")
-    st.metric("Messages Exchanged", len(st.session_state.messages))
-    st.metric("Model Used", selected_model.split(" (")[0])
-
-# Enhanced system prompt based on user preferences
-def create_system_prompt(expertise_areas):
-    base_prompt = """You are an expert fund manager and financial analyst with deep expertise in investment strategies, market analysis, and financial instruments. You have years of experience in both traditional and modern financial markets."""
+    st.metric("Messages Exchanged", len(st.session_state.history))
+    st.metric("Model Used", model_name if race_mode else selected_model.split(" (")[0])
     
-    if expertise_areas:
-        expertise_text = ", ".join(expertise_areas).lower()
-        base_prompt += f"\n\nYour current focus areas include: {expertise_text}. Provide detailed, actionable insights in these areas."
+    cache_stats = st.session_state.cache_stats
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    col1, col2 = st.columns(2)
+    col1.metric("Cache Hits", cache_stats["hits"])
+    col2.metric("Cache Misses", cache_stats["misses"])
+    st.caption(f"Hit rate {cache_stats['hits'] / lookups if lookups else 0:.0%} · "
+               f"{len(get_response_cache())}/{RESPONSE_CACHE_SIZE} cached answers")
     
-    base_prompt += """
+    # Compare view: per-model averages over this session's races
+    if st.session_state.race_results:
+        with st.expander("🏁 Race Compare", expanded=False):
+            by_model = {}
+            for result in st.session_state.race_results:
+                by_model.setdefault(result["model"], []).append(result)
+            
+            def average(results, field, digits=None):
+                # Failed turns have no meaningful latency or usage, so they only count as errors
+                values = [r[field] for r in results if not r["error"] and r[field] is not None]
+                return round(sum(values) / len(values), digits) if values else None
+            
+            st.dataframe([
+                {
+                    "Model": model,
+                    "Turns": len(results),
+                    "First token (s)": average(results, "first_token", 2),
+                    "Total (s)": average(results, "latency", 2),
+                    "Input tokens": average(results, "input_tokens"),
+                    "Output tokens": average(results, "output_tokens"),
+                    "Errors": sum(1 for r in results if r["error"]),
+                }
+                for model, results in by_model.items()
+            ], hide_index=True)
+
+# Static part of the system prompt. It always comes first and never changes, so
+# providers that cache prompt prefixes can reuse it across turns and sessions.
+BASE_SYSTEM_PROMPT = """You are an expert fund manager and financial analyst with deep expertise in investment strategies, market analysis, and financial instruments. You have years of experience in both traditional and modern financial markets.
     
     Guidelines for responses:
     - Provide data-driven insights when possible
@@ -147,43 +455,107 @@ def create_system_prompt(expertise_areas):
     - Always remind users that this is not personalized financial advice
     
     Format your responses clearly with bullet points or sections when appropriate."""
+
+@functools.lru_cache(maxsize=None)
+def _system_prompt(expertise_key):
+    if not expertise_key:
+        return BASE_SYSTEM_PROMPT
+    expertise_text = ", ".join(expertise_key).lower()
+    return BASE_SYSTEM_PROMPT + f"\n\nYour current focus areas include: {expertise_text}. Provide detailed, actionable insights in these areas."
+
+# Enhanced system prompt based on user preferences, built once per expertise set
+def create_system_prompt(expertise_areas):
+    # The same selection gives a byte-identical prompt whatever order it was picked in
+    return _system_prompt(tuple(area for area in EXPERTISE_AREAS if area in expertise_areas))
+
+# One client, and so one pool of warm HTTPS connections, per setting for every session and rerun
+@st.cache_resource(show_spinner=False)
+def get_llm(model_name, temperature, max_tokens=1500):
+    return ChatOpenAI(
+        model_name=model_name,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        streaming=True,
+        stream_usage=True
+    )
+
+# Runs the strong model of a race while the fast one streams in the script thread
+@st.cache_resource
+def get_race_executor():
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="race")
+
+# Enhanced chat function with memory, streamed token by token.
+# When `stats` is given it is filled with latency and token usage as the stream runs.
+# Off the script thread, pass `llm` in: get_llm needs Streamlit's script context.
+def stream_ai_response(message, expertise_areas, model_name, temperature, conversation_history_str, summary="", stats=None,
+                       llm=None):
+    stats = {} if stats is None else stats
+    stats.update(model=model_name, first_token=None, latency=0.0, input_tokens=0, output_tokens=0, error=None)
+    start = time.perf_counter()
+    llm = get_llm(model_name, temperature) if llm is None else llm
+    
+    messages = [SystemMessage(content=create_system_prompt(expertise_areas))]
+    if summary:
+        messages.append(SystemMessage(content=f"Summary of the earlier conversation:\n{summary}"))
+        
+    # Add conversation history, already trimmed to the token budget
+    for role, content in conversation_history_str:
+        if role == "user":
+            messages.append(HumanMessage(content=content))
+        else:
+            messages.append(AIMessage(content=content))
     
-    return base_prompt
+    # Add current message
+    messages.append(HumanMessage(content=message))
+    
+    for chunk in llm.stream(messages):
+        if chunk.usage_metadata:
+            stats["input_tokens"] = chunk.usage_metadata["input_tokens"]
+            stats["output_tokens"] = chunk.usage_metadata["output_tokens"]
+        if chunk.content:
+            if stats["first_token"] is None:
+                stats["first_token"] = time.perf_counter() - start
+            yield chunk.content
+    stats["latency"] = time.perf_counter() - start
 
-# Enhanced chat function with memory
-@st.cache_data(show_spinner=False)
-def get_ai_response(message, expertise_areas, model_name, temperature, conversation_history_str):
+def run_ai_response(*args, llm):
+    # Whole answer plus its stats, for the model racing in the background
+    stats = {}
     try:
-        llm = ChatOpenAI(
-            model_name=model_name,
-            temperature=temperature,
-            max_tokens=1500
-        )
-        
-        messages = [SystemMessage(content=create_system_prompt(expertise_areas))]
-        
-        # Add conversation history (last 3 messages to manage token limit)
-        for role, content in conversation_history_str[-3:]:
-            if role == "user":
-                messages.append(HumanMessage(content=content))
-            else:
-                messages.append(AIMessage(content=content))
-        
-        # Add current message
-        messages.append(HumanMessage(content=message))
-        
-        response = llm.invoke(messages)
-        return response.content, None
-        
+        return "".join(stream_ai_response(*args, stats=stats, llm=llm)), stats
     except Exception as e:
-        return None, str(e)
+        stats["error"] = str(e)
+        return None, stats
+
+def race_summary(stats):
+    if stats["error"]:
+        return f"{stats['model']}: failed"
+    return (f"{stats['model']}: first token {stats['first_token'] or 0:.1f}s, total {stats['latency']:.1f}s, "
+            f"{stats['input_tokens']} in / {stats['output_tokens']} out tokens")
+
+def summarize_turns(summary, turns):
+    llm = get_llm(SUMMARY_MODEL, 0.0, max_tokens=300)
+    transcript = "\n".join(f"{role}: {content}" for role, content in turns)
+    response = llm.invoke([
+        SystemMessage(content="Update the running summary of a finance conversation. Keep facts, figures, "
+                              "the user's goals and any advice given. Reply with the summary only."),
+        HumanMessage(content=f"Current summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}")
+    ])
+    return response.content
 
 
 # Display chat history
 chat_container = st.container()
 
 with chat_container:
-    for i, message in enumerate(st.session_state.messages):
+    # Only the newest pages are read and rendered, however long the conversation is
+    history = st.session_state.history
+    hidden = len(history) - st.session_state.visible_messages
+    if hidden > 0 and st.button(f"⬆️ Load earlier messages ({hidden} more)"):
+        st.session_state.visible_messages += CHAT_PAGE_SIZE
+        st.rerun()
+    
+    for i, message in enumerate(history.store.messages(history.conversation_id, st.session_state.visible_messages)):
         if message["role"] == "user":
             with st.chat_message("user", avatar="🧑‍💼"):
                 st.markdown(message["content"])
@@ -193,8 +565,12 @@ with chat_container:
 
 # Chat input
 if prompt := st.chat_input("Ask me anything about finance, investing, or trading..."):
+    history = st.session_state.history
+    # History sent with this turn, trimmed by tokens before the new prompt joins it
+    conversation_history_str = history.window(HISTORY_TOKEN_BUDGET)
+    
     # Add user message
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    history.add("user", prompt)
     
     # Display user message
     with st.chat_message("user", avatar="🧑‍💼"):
@@ -202,35 +578,93 @@ if prompt := st.chat_input("Ask me anything about finance, investing, or trading
     
     # Generate AI response
     with st.chat_message("assistant", avatar="💰"):
-        with st.spinner("Analyzing your question..."):
-            # Convert messages to LangChain format for memory
-            conversation_history_str = []
-            for msg in st.session_state.messages[:-1]:  # Exclude the current prompt
-                conversation_history_str.append((msg["role"], msg["content"]))
-            
-            response, error = get_ai_response(
-                prompt, 
-                expertise_areas, 
-                model_name, 
-                temperature,
-                conversation_history_str
+        response_cache = get_response_cache()
+        cache_key = ResponseCache.key(
+            create_system_prompt(expertise_areas) + history.summary,
+            conversation_history_str,
+            prompt,
+            model_name,
+            temperature
+        )
+        response, error = response_cache.get(cache_key), None
+        
+        if response:
+            st.session_state.cache_stats["hits"] += 1
+            st.markdown(response)
+        elif race_mode:
+            st.session_state.cache_stats["misses"] += 1
+            strong = get_race_executor().submit(
+                run_ai_response, prompt, expertise_areas, model_name, temperature, conversation_history_str, history.summary,
+                llm=get_llm(model_name, temperature)
             )
             
-            if response:
-                st.markdown(response)
-                st.session_state.messages.append({"role": "assistant", "content": response})
-                
-                # Add to memory
-                st.session_state.memory.save_context(
-                    {"input": prompt},
-                    {"output": response}
-                )
+            answer = st.empty()
+            fast_stats = {}
+            try:
+                with answer.container():
+                    fast_response = st.write_stream(stream_ai_response(
+                        prompt,
+                        expertise_areas,
+                        fast_model,
+                        temperature,
+                        conversation_history_str,
+                        history.summary,
+                        stats=fast_stats
+                    ))
+            except Exception as e:
+                fast_response, fast_stats["error"] = None, str(e)
+            
+            with st.spinner(f"Waiting for {model_name}..."):
+                strong_response, strong_stats = strong.result()
+            
+            if strong_response:
+                # Swap in the strong answer; the fast one stays available in the comparison
+                answer.markdown(strong_response)
+                response_cache.set(cache_key, strong_response)
+                response = strong_response
+                st.caption(f"⚡ Replaced the {fast_model} answer with {model_name}")
             else:
-                st.error(f"❌ Error generating response: {error}")
-                st.info("💡 Tips: Check your API key in .env file and ensure you have sufficient OpenAI credits.")
+                response, error = fast_response, strong_stats["error"]
+                if response:
+                    st.caption(f"⚠️ {model_name} failed, showing the {fast_model} answer")
+            
+            st.session_state.race_results.extend([fast_stats, strong_stats])
+            with st.expander("🏁 Compare answers"):
+                col1, col2 = st.columns(2)
+                for column, stats, text in ((col1, fast_stats, fast_response), (col2, strong_stats, strong_response)):
+                    column.caption(race_summary(stats))
+                    column.markdown(text or f"❌ {stats['error']}")
+        else:
+            st.session_state.cache_stats["misses"] += 1
+            # Tokens are written into the bubble as they arrive; write_stream returns the full text
+            try:
+                response = st.write_stream(stream_ai_response(
+                    prompt, 
+                    expertise_areas, 
+                    model_name, 
+                    temperature,
+                    conversation_history_str,
+                    history.summary
+                ))
+                if response:
+                    response_cache.set(cache_key, response)
+            except Exception as e:
+                response, error = None, str(e)
+        
+        if response:
+            history.add("assistant", response)
+            
+            if summarize_history:
+                try:
+                    history.roll_summary(HISTORY_TOKEN_BUDGET, summarize_turns)
+                except Exception:
+                    pass  # Keep the old summary; the turns are retried next time
+        else:
+            st.error(f"❌ Error generating response: {error or 'empty response'}")
+            st.info("💡 Tips: Check your API key in .env file and ensure you have sufficient OpenAI credits.")
 
 # Sample questions section (UX improvement)
-if len(st.session_state.messages) == 0:
+if len(st.session_state.history) == 0:
     st.markdown("### 🤔 Not sure what to ask? Try those question: ")
     
     col1, col2 = st.columns(2)